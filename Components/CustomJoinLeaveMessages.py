@@ -4,9 +4,10 @@ from loguru import logger
 import db
 
 
-async def send_log(member):
-    """Sends the message for when a user joins or leave a guild"""
-    config = await CustomJoinLeaveMessages.get_by(guild_id=member.guild.id)
+async def send_log(member, config=None):
+    """Sends the message for when a user joins or leave a guild. `config` may be passed in if it was already loaded."""
+    if config is None:
+        config = await CustomJoinLeaveMessages.get_by(guild_id=member.guild.id)
     if len(config):
         channel = member.guild.get_channel(config[0].channel_id)
         if channel:
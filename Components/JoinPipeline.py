@@ -0,0 +1,114 @@
+"""Batched loading of the database state that member join handlers need, shared between every cog."""
+import asyncio
+import json
+from typing import Dict, Tuple
+
+import discord
+from loguru import logger
+
+import db
+
+
+class JoinState:
+    """The database state loaded for one joining member, as lists of table objects keyed by table."""
+
+    def __init__(self, records: Dict[str, list]):
+        self._records = records
+
+    def get(self, table) -> list:
+        """Returns the records of `table` that belong to this member (or to their guild, for guild tables)."""
+        return self._records.get(table.__tablename__, [])
+
+
+class JoinPipeline:
+    """
+    Loads per-guild and per-member state for joining members in one query per batch, then dispatches
+    `on_member_join_state(member, state)` to every cog. Cogs register the tables they need instead of querying them
+    individually in on_member_join, and joins arriving within `window` seconds of each other share one query, so a
+    join raid costs a handful of queries instead of several per member.
+    """
+
+    def __init__(self, bot, window: float = 0.25, max_batch: int = 100):
+        self.bot = bot
+        self.window = window
+        self.max_batch = max_batch
+        self.guild_tables: Dict[str, Tuple[type, str]] = {}  # tablename: (table, guild column)
+        self.member_tables: Dict[str, Tuple[type, str, str]] = {}  # tablename: (table, guild column, member column)
+        self._queue: Dict[Tuple[int, int], asyncio.Future] = {}
+        self._flush_handle = None
+        bot.add_listener(self.on_member_join)
+
+    def register_guild_table(self, table, guild_column: str = "guild_id"):
+        """Registers a table whose rows for the member's guild should be loaded on join."""
+        self.guild_tables[table.__tablename__] = (table, guild_column)
+
+    def register_member_table(self, table, member_column: str = "member_id", guild_column: str = "guild_id"):
+        """Registers a table whose rows for the joining member in that guild should be loaded on join."""
+        self.member_tables[table.__tablename__] = (table, guild_column, member_column)
+
+    async def on_member_join(self, member: discord.Member):
+        """Loads the member's state and hands it to the cogs."""
+        state = await self.state_for(member)
+        self.bot.dispatch("member_join_state", member, state)
+
+    async def state_for(self, member: discord.Member) -> JoinState:
+        """Returns the join state of a member, batching the load with other joins that arrive around the same time."""
+        key = (member.guild.id, member.id)
+        future = self._queue.get(key)
+        if future is None:
+            future = self._queue[key] = asyncio.get_running_loop().create_future()
+            if len(self._queue) >= self.max_batch:
+                asyncio.create_task(self._flush())
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(
+                    self.window, lambda: asyncio.create_task(self._flush()))
+        return await future
+
+    def _build_query(self, tables):
+        """Builds one query selecting, per (guild_id, member_id) pair, a JSON array of rows for each table."""
+        columns = []
+        for i, name in enumerate(tables):
+            if name in self.guild_tables:
+                _, guild_column = self.guild_tables[name]
+                condition = f"t.{guild_column} = m.guild_id"
+            else:
+                _, guild_column, member_column = self.member_tables[name]
+                condition = f"t.{guild_column} = m.guild_id AND t.{member_column} = m.member_id"
+            columns.append(f"(SELECT coalesce(json_agg(t), '[]') FROM {name} t WHERE {condition}) AS t{i}")
+        return f"""SELECT m.guild_id, m.member_id, {', '.join(columns)}
+                FROM unnest($1::bigint[], $2::bigint[]) AS m(guild_id, member_id)"""
+
+    async def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._queue = self._queue, {}
+        if not batch:
+            return
+
+        tables = {name: entry[0] for name, entry in {**self.guild_tables, **self.member_tables}.items()}
+        try:
+            if tables:
+                for name in tables:
+                    await db.Writer.flush_table(name)
+                guild_ids, member_ids = zip(*batch)
+                async with db.Pool.acquire() as conn:
+                    rows = await conn.fetch(self._build_query(tables), list(guild_ids), list(member_ids))
+            else:
+                rows = []
+        except Exception as e:
+            logger.error(f"Failed to load join state for {len(batch)} member(s): {e}")
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        states = {}
+        for row in rows:
+            records = {name: [table.from_record(record) for record in json.loads(row[f"t{i}"])]
+                       for i, (name, table) in enumerate(tables.items())}
+            states[(row["guild_id"], row["member_id"])] = JoinState(records)
+        logger.debug(f"Loaded join state for {len(batch)} member(s) in one query")
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(states.get(key, JoinState({})))
@@ -0,0 +1,192 @@
+"""Opt-in persistent store of message content, so edit and delete logs can show messages that left the bot's cache."""
+import asyncio
+import zlib
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import discord
+from loguru import logger
+
+import db
+
+
+class StoredMessage:
+    """A message loaded from the store."""
+
+    __slots__ = ('message_id', 'guild_id', 'channel_id', 'author_id', 'content')
+
+    def __init__(self, message_id: int, guild_id: int, channel_id: int, author_id: int, content: str):
+        self.message_id = message_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.content = content
+
+class MessageStore:
+    """
+    Writes message content of opted-in guilds to the message_store table in batches, zlib compressed, and reads it back
+    for edit/delete logs. Rows are kept for each guild's configured retention, capped to its configured number of rows.
+    """
+
+    def __init__(self, flush_interval: float = 5, max_pending: int = 500):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.configs: Optional[Dict[int, MessageStoreConfig]] = None  # guild_id: config, loaded on first use
+        self.pending: Dict[int, Tuple[int, int, int, int, bytes]] = {}  # message_id: row waiting to be written
+        self.deleted: Set[int] = set()  # ids of deleted messages waiting to be dropped
+        self._flush_handle = None
+        self._flush_lock = asyncio.Lock()
+
+    async def load_configs(self):
+        """Loads the store settings of every guild that opted in."""
+        self.configs = {config.guild_id: config for config in await MessageStoreConfig.get_by()}
+
+    async def enabled(self, guild_id: int) -> bool:
+        """Returns whether a guild opted in to storing messages."""
+        if self.configs is None:
+            await self.load_configs()
+        return guild_id in self.configs
+
+    @staticmethod
+    def encode(content: str) -> bytes:
+        """Compresses message content for storage"""
+        return zlib.compress(content.encode('utf-8'), 6)
+
+    @staticmethod
+    def decode(data: bytes) -> str:
+        """Decompresses stored message content"""
+        return zlib.decompress(data).decode('utf-8')
+
+    def store(self, message_id: int, guild_id: int, channel_id: int, author_id: int, content: str):
+        """Queues a message, or the new content of an edited one, to be written on the next flush."""
+        self.pending[message_id] = (message_id, guild_id, channel_id, author_id, self.encode(content or ""))
+        self.deleted.discard(message_id)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        """Flushes now if enough writes are queued, otherwise makes sure a flush is scheduled."""
+        if len(self.pending) + len(self.deleted) >= self.max_pending:
+            asyncio.create_task(self.flush())
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.flush_interval, lambda: asyncio.create_task(self.flush()))
+
+    async def get(self, message_id: int) -> Optional[StoredMessage]:
+        """Returns the stored message with the given ID, if there is one."""
+        if message_id in self.deleted:
+            return None
+        row = self.pending.get(message_id)
+        if row is None:
+            async with db.Pool.acquire() as conn:
+                row = await conn.fetchrow(f"""SELECT message_id, guild_id, channel_id, author_id, content
+                FROM {MessageStoreConfig.store_table} WHERE message_id = $1""", message_id)
+            if row is None:
+                return None
+        return StoredMessage(row[0], row[1], row[2], row[3], self.decode(row[4]))
+
+    def forget(self, message_ids: Iterable[int]):
+        """Queues deleted messages to be dropped from the store on the next flush."""
+        for message_id in message_ids:
+            # a message still queued was never written, so dropping it from the queue is enough
+            if self.pending.pop(message_id, None) is None:
+                self.deleted.add(message_id)
+        if self.deleted:
+            self._schedule_flush()
+
+    async def flush(self):
+        """Writes every queued message and drops every queued deletion, in one batch each."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        async with self._flush_lock:
+            rows, self.pending = list(self.pending.values()), {}
+            deleted, self.deleted = list(self.deleted), set()
+            if not rows and not deleted:
+                return
+            try:
+                async with db.Pool.acquire() as conn:
+                    if deleted:
+                        await conn.execute(f"DELETE FROM {MessageStoreConfig.store_table} WHERE message_id = ANY($1)",
+                                           deleted)
+                    if rows:
+                        await conn.executemany(f"""INSERT INTO {MessageStoreConfig.store_table}
+                        (message_id, guild_id, channel_id, author_id, content) VALUES ($1, $2, $3, $4, $5)
+                        ON CONFLICT (message_id) DO UPDATE SET content = EXCLUDED.content""", rows)
+            except Exception as e:
+                logger.error(f"Failed to write {len(rows)} message(s) and drop {len(deleted)} deleted message(s) in "
+                             f"the message store: {e}")
+
+    async def purge(self):
+        """Deletes messages past their guild's retention or row limit, and messages of guilds that opted out."""
+        if self.configs is None:
+            await self.load_configs()
+        table = MessageStoreConfig.store_table
+        async with db.Pool.acquire() as conn:
+            # message ids are snowflakes, so comparing against a snowflake of the cutoff time compares send times
+            await conn.execute(f"""DELETE FROM {table} s USING {MessageStoreConfig.__tablename__} c
+            WHERE s.guild_id = c.guild_id AND s.message_id < ((extract(epoch FROM now() - c.retention_days * interval '1 day')
+            * 1000)::bigint - {discord.utils.DISCORD_EPOCH}) << 22""")
+            await conn.execute(f"""DELETE FROM {table} s WHERE NOT EXISTS
+            (SELECT 1 FROM {MessageStoreConfig.__tablename__} c WHERE c.guild_id = s.guild_id)""")
+            await conn.execute(f"""DELETE FROM {table} WHERE message_id IN (SELECT message_id FROM (
+            SELECT s.message_id, c.max_messages, row_number() OVER (PARTITION BY s.guild_id ORDER BY s.message_id DESC) AS n
+            FROM {table} s JOIN {MessageStoreConfig.__tablename__} c ON c.guild_id = s.guild_id) ranked
+            WHERE n > max_messages)""")
+
+    async def configure(self, guild_id: int, retention_days: int, max_messages: int):
+        """Opts a guild in to the store, or updates its retention."""
+        config = MessageStoreConfig(guild_id=guild_id, retention_days=retention_days, max_messages=max_messages)
+        await config.update_or_add()
+        if self.configs is not None:
+            self.configs[guild_id] = config
+
+    async def disable(self, guild_id: int):
+        """Opts a guild out of the store and deletes what was stored for it."""
+        await MessageStoreConfig.delete(guild_id=guild_id)
+        if self.configs is not None:
+            self.configs.pop(guild_id, None)
+        self.pending = {message_id: row for message_id, row in self.pending.items() if row[1] != guild_id}
+        async with db.Pool.acquire() as conn:
+            await conn.execute(f"DELETE FROM {MessageStoreConfig.store_table} WHERE guild_id = $1", guild_id)
+
+
+class MessageStoreConfig(db.DatabaseTable):
+    """Guilds that opted in to storing message content, and how long to keep it. Also creates the store table."""
+    __tablename__ = 'message_store_config'
+    __uniques__ = 'guild_id'
+    store_table = 'message_store'
+
+    @classmethod
+    async def initial_create(cls):
+        """Create the table in the database"""
+        async with db.Pool.acquire() as conn:
+            await conn.execute(f"""
+            CREATE TABLE {cls.__tablename__} (
+            guild_id bigint PRIMARY KEY NOT NULL,
+            retention_days int NOT NULL,
+            max_messages int NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS {cls.store_table} (
+            message_id bigint PRIMARY KEY NOT NULL,
+            guild_id bigint NOT NULL,
+            channel_id bigint NOT NULL,
+            author_id bigint NOT NULL,
+            content bytea NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS {cls.store_table}_guild_id ON {cls.store_table} (guild_id, message_id);
+            """)
+
+    def __init__(self, guild_id: int, retention_days: int, max_messages: int):
+        super().__init__()
+        self.guild_id = guild_id
+        self.retention_days = retention_days
+        self.max_messages = max_messages
+
+    @classmethod
+    async def get_by(cls, **kwargs):
+        results = await super().get_by(**kwargs)
+        result_list = []
+        for result in results:
+            obj = MessageStoreConfig(guild_id=result.get("guild_id"), retention_days=result.get("retention_days"),
+                                     max_messages=result.get("max_messages"))
+            result_list.append(obj)
+        return result_list
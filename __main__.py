@@ -49,7 +49,13 @@ config = {
     'is_backup': False,
     'invite_override': "",
     "sentry_url": "",
-    "disabled_cogs": []
+    "disabled_cogs": [],
+    "metrics_port": 0,
+    "ratelimits": {
+        "user": [5, 5],
+        "guild": [30, 10],
+        "command": [2, 3]
+    }
 }
 config_file = 'config.json'
 
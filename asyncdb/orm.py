@@ -14,6 +14,7 @@ One can use the defualt orm instance or instantiate your own for other dbs.
 """
 import json
 import asyncio
+import re
 import asyncpg
 
 from .psqlt import Column
@@ -27,6 +28,16 @@ class class_or_instancemethod(classmethod):
         return descr_get(instance, type_)
 
 
+# row locks (FOR UPDATE/NO KEY UPDATE/SHARE/KEY SHARE) only last until the end of the transaction, and SELECT INTO
+# creates a table, so statements with either aren't treated as read-only
+_WRITE_CLAUSES = re.compile(r"\bFOR\s+(?:NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b|\bINTO\b", re.IGNORECASE)
+
+
+def _is_read_only(query: str) -> bool:
+    """Returns whether a statement is a plain SELECT that neither locks rows nor writes"""
+    return query.lstrip()[:6].upper() == "SELECT" and _WRITE_CLAUSES.search(query) is None
+
+
 # pylint: disable=not-an-iterable,too-many-statements,too-many-locals
 class ORM:
     """Wrapper class for everything I guess..."""
@@ -112,11 +123,17 @@ class ORM:
             async def _fetch(cls, args, _one=False, conn=None):
                 try:
                     f = 'fetchrow' if _one else 'fetch'
+                    # a single read-only statement is already atomic, so it skips the BEGIN/COMMIT round trips
+                    read_only = _is_read_only(args[0])
                     if conn is None:
                         async with cls._orm.pool.acquire() as conn:
+                            if read_only:
+                                return await getattr(conn, f)(*args)
                             async with conn.transaction():
                                 return await getattr(conn, f)(*args)
                     else:
+                        if read_only:
+                            return await getattr(conn, f)(*args)
                         async with conn.transaction():
                             return await getattr(conn, f)(*args)
                 except asyncpg.PostgresError:
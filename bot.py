@@ -1,8 +1,12 @@
 """Bot object for Dozer"""
 
+import asyncio
+import hashlib
+import json
 import os
 import re
 import sys
+import time
 import traceback
 
 import discord
@@ -12,9 +16,14 @@ from sentry_sdk import capture_exception
 
 from typing import Pattern
 import utils
-from cogs._utils import CommandMixin
+from cogs._utils import CommandMixin, PrefixHandler
+import db
 from db import db_init, db_migrate
 from context import DozerContext
+from timers import TimerScheduler
+from ratelimit import CommandRateLimiter
+import metrics
+from Components.JoinPipeline import JoinPipeline
 
 # from asyncdb.orm import orm #this is for the database that dozer uses
 
@@ -40,29 +49,112 @@ class InvalidContext(commands.CheckFailure):
 
 class Dozer(commands.Bot):
     """Botty things that are critical to Dozer working"""
-    _global_cooldown = commands.Cooldown(1, 1)  # One command per second per user
+    command_tree_cache = 'command_tree.json'  # fingerprints of the app commands last synced to each scope
 
     def __init__(self, config):
-        super().__init__(command_prefix = config['prefix'], intents = intents, case_insensitive = True)
+        dynamic_prefix = PrefixHandler(config['prefix'])
+        super().__init__(command_prefix = dynamic_prefix.handler, intents = intents, case_insensitive = True)
+        self.dynamic_prefix = dynamic_prefix
         self.config = config
         self._restarting = False
         self.check(self.global_checks)
         self.http_session = None
         self.aiohttp_sessions = []
+        self.timers = TimerScheduler()
+        self.ratelimiter = CommandRateLimiter(config.get('ratelimits'))
+        self.http.request = metrics.timed_http(self.http.request)
+        self.metrics_server = metrics.MetricsServer(config['metrics_port']) if config.get('metrics_port') else None
+        self.join_pipeline = JoinPipeline(self)
+        self.startup_timings = {}  # phase: seconds, filled in while the bot starts
+        self._startup_started = None
+        self._db_setup = None
+        self._tree_fingerprints = None
+
+    async def login(self, token: str) -> None:
+        # the database pool connects while discord.py logs in and the cogs load
+        self._startup_started = time.perf_counter()
+        self._db_setup = asyncio.create_task(self.setup_db())
+        await super().login(token)
+
+    async def setup_db(self):
+        """Connects to the database"""
+        start = time.perf_counter()
+        await db_init(self.config['db_url'])
+        self.startup_timings['database connect'] = time.perf_counter() - start
 
     async def setup_hook(self) -> None:
-        for ext in os.listdir('cogs'):
-            cog_name = ext[:-3]
+        if self._startup_started is not None:
+            self.startup_timings['login'] = time.perf_counter() - self._startup_started
+
+        start = time.perf_counter()
+        disabled = set(self.config.get('disabled_cogs', []))
+        cog_timings = {}
+        for ext in sorted(os.listdir('cogs')):
+            cog_name = ext[:-3]  # Remove '.py'
             if not ext.startswith(('_', '.')) and ext.endswith(".py"):
-                await self.load_extension('cogs.' + cog_name)  # Remove '.py'
+                if cog_name in disabled:
+                    logger.info(f"Skipping disabled cog {cog_name}")
+                    continue
+                cog_start = time.perf_counter()
+                await self.load_extension('cogs.' + cog_name)
+                cog_timings[cog_name] = time.perf_counter() - cog_start
+        self.startup_timings['cogs'] = time.perf_counter() - start
 
-        await db_init(self.config['db_url'])
+        start = time.perf_counter()
+        if self._db_setup is None:
+            self._db_setup = asyncio.create_task(self.setup_db())
+        await self._db_setup
+        self.startup_timings['waiting on database'] = time.perf_counter() - start
+        # migrations run once every cog is loaded, since they cover the tables of every imported DatabaseTable
+        start = time.perf_counter()
         await db_migrate()
+        self.startup_timings['migrations'] = time.perf_counter() - start
+        await self.dynamic_prefix.refresh()
+        self.timers.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+
+        start = time.perf_counter()
         self.tree.copy_global_to(guild = MY_GUILD)  # these 2 lines rely on MY_GUILD, which by default is set to be
         # the FTC discord (faster command syncing when it's specified)
         self.tree.clear_commands(guild = MY_GUILD)
-        await self.tree.sync(guild = MY_GUILD)
-        await self.tree.sync()
+        await self.sync_commands(MY_GUILD)
+        await self.sync_commands()
+        self.startup_timings['command sync'] = time.perf_counter() - start
+
+        slowest = sorted(cog_timings.items(), key = lambda item: item[1], reverse = True)[:3]
+        logger.info("Startup timings: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in
+                                                     self.startup_timings.items()))
+        logger.info("Slowest cogs: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in slowest))
+
+    def command_tree_fingerprint(self, guild: discord.abc.Snowflake = None) -> str:
+        """Returns a stable hash of the app command payloads of a scope (a guild, or global)"""
+        payload = sorted((cmd.to_dict() for cmd in self.tree.get_commands(guild = guild)),
+                         key = lambda cmd: (cmd.get('type', 1), cmd['name']))
+        return hashlib.sha256(json.dumps(payload, sort_keys = True, default = str).encode()).hexdigest()
+
+    async def sync_commands(self, guild: discord.abc.Snowflake = None, force: bool = False) -> bool:
+        """Syncs the app commands of a scope, unless they are unchanged since they were last synced. Returns whether a
+        sync was made."""
+        if self._tree_fingerprints is None:
+            try:
+                with open(self.command_tree_cache) as f:
+                    self._tree_fingerprints = json.load(f)
+            except (OSError, ValueError):
+                self._tree_fingerprints = {}
+        scope = f"{self.application_id}:{guild.id if guild else 'global'}"
+        fingerprint = self.command_tree_fingerprint(guild)
+        if not force and self._tree_fingerprints.get(scope) == fingerprint:
+            logger.debug(f"App commands of {scope} are unchanged, skipping sync")
+            return False
+        await self.tree.sync(guild = guild)
+        self._tree_fingerprints[scope] = fingerprint
+        try:
+            with open(self.command_tree_cache, 'w') as f:
+                json.dump(self._tree_fingerprints, f, indent = '\t')
+        except OSError as e:
+            logger.warning(f"Couldn't save app command fingerprints: {e}")
+        return True
 
     async def on_ready(self):
         """Things to run when the bot has initialized and signed in"""
@@ -92,6 +184,9 @@ class Dozer(commands.Bot):
         return ctx
 
     async def on_command_error(self, context: DozerContext, exception):  # pylint: disable=arguments-differ
+        # after-invoke hooks already recorded invocations whose callback raised, and finish_command skips spans that were
+        # recorded, so this only closes invocations that failed in a before-invoke hook
+        metrics.finish_command(context)
         if isinstance(exception, commands.NoPrivateMessage):
             await context.send(f'{context.author.mention}, This command cannot be used in DMs.')
         elif isinstance(exception, commands.UserInputError):
@@ -155,9 +250,12 @@ class Dozer(commands.Bot):
         """Checks that should be executed before passed to the command"""
         if ctx.author.bot:
             raise InvalidContext('Bots cannot run commands!')
-        retry_after = self._global_cooldown.update_rate_limit()
-        if retry_after and not hasattr(ctx, "is_pseudo"):  # bypass ratelimit for su'ed commands
-            raise InvalidContext('Global rate-limit exceeded!')
+        if hasattr(ctx, "is_pseudo"):  # bypass ratelimit for su'ed commands
+            return True
+        retry_after = self.ratelimiter.hit(ctx.author.id, ctx.guild.id if ctx.guild else None,
+                                           ctx.command.qualified_name if ctx.command else None)
+        if retry_after:
+            raise InvalidContext(f'Rate limit exceeded! Try again in {retry_after:.1f}s')
         return True
 
     def run(self, *args, **kwargs):
@@ -174,6 +272,10 @@ class Dozer(commands.Bot):
     async def close(self):
         """performs cleanup and actually shuts down the bot"""
         logger.info("Bot is shutting down...")
+        await self.timers.stop()
+        await db.Writer.flush()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
         await super().close()
         for ses in self.aiohttp_sessions:
             await ses.close()
@@ -13,6 +13,7 @@ from discord.ext.commands import HybridCommand
 from discord.ext.commands.core import MISSING
 
 import db
+import metrics
 from context import DozerContext
 
 __all__ = ['bot_has_permissions', 'command', 'group', 'Cog', 'Reactor', 'Paginator', 'paginate', 'chunk', 'dev_check',
@@ -34,6 +35,18 @@ class CommandMixin:
             # This doesn't need to go into __original_kwargs__ because it'll be read from func each time
             self._required_permissions = func.__required_permissions__
 
+    async def call_before_hooks(self, ctx):
+        """Starts timing the invocation, then runs the usual before-invoke hooks"""
+        metrics.start_command(ctx, self.qualified_name)
+        await super().call_before_hooks(ctx)
+
+    async def call_after_hooks(self, ctx):
+        """Runs the usual after-invoke hooks, then records the invocation time"""
+        try:
+            await super().call_after_hooks(ctx)
+        finally:
+            metrics.finish_command(ctx, self.qualified_name)
+
     @property
     def required_permissions(self):
         """Required permissions handler"""
@@ -112,6 +125,10 @@ class Cog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         super().__init__()
         self.bot = bot
+        # time every listener; the wrappers are instance attributes, so discord.py registers and removes them
+        for method_name in {method_name for _, method_name in self.__cog_listeners__}:
+            setattr(self, method_name, metrics.instrument_listener(f"{type(self).__name__}.{method_name}",
+                                                                   getattr(self, method_name)))
 
 
 def dev_check():
@@ -355,19 +372,38 @@ class PrefixHandler:
 
     def __init__(self, default_prefix: str):
         self.default_prefix = default_prefix
-        self.prefix_cache: Dict[int, DynamicPrefixEntry] = {}
+        self.prefix_cache: Dict[int, str] = {}
+        self.prefix_lists: Dict[int, list] = {}  # guild_id: prefixes returned for that guild, built once per change
+        self.mentions = None
+        self.default_list = None
+
+    def _build(self, prefix: str):
+        """Builds the list of prefixes returned for a guild"""
+        return [*self.mentions, prefix or self.default_prefix]
 
     def handler(self, bot, message: discord.Message):
         """Process the dynamic prefix for each message"""
-        dynamic = self.prefix_cache.get(message.guild.id) if message.guild else self.default_prefix
-        # <@!> is a nickname mention which discord.py doesn't make by default
-        return [f"<@!{bot.user.id}> ", bot.user.mention, dynamic if dynamic else self.default_prefix]
+        if self.mentions is None:
+            # <@!> is a nickname mention which discord.py doesn't make by default
+            self.mentions = (f"<@!{bot.user.id}> ", bot.user.mention)
+            self.default_list = self._build(self.default_prefix)
+            self.prefix_lists = {guild_id: self._build(prefix) for guild_id, prefix in self.prefix_cache.items()}
+        if message.guild is None:
+            return self.default_list
+        return self.prefix_lists.get(message.guild.id, self.default_list)
+
+    def set_prefix(self, guild_id: int, prefix: str):
+        """Updates the prefix of a single guild"""
+        self.prefix_cache[guild_id] = prefix
+        if self.mentions is not None:
+            self.prefix_lists[guild_id] = self._build(prefix)
 
     async def refresh(self):
         """Refreshes the prefix cache"""
         prefixes = await DynamicPrefixEntry.get_by()  # no filters, get all
-        for prefix in prefixes:
-            self.prefix_cache[prefix.guild_id] = prefix.prefix
+        self.prefix_cache = {prefix.guild_id: prefix.prefix for prefix in prefixes}
+        if self.mentions is not None:
+            self.prefix_lists = {guild_id: self._build(prefix) for guild_id, prefix in self.prefix_cache.items()}
         logger.info(f"{len(prefixes)} prefixes loaded from database")
 
 
@@ -1,11 +1,14 @@
 """Provides guild logging functions for Dozer."""
 import asyncio
 import datetime
+import gzip
+import io
 import math
 import time
+from collections import deque
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import has_permissions, BadArgument
 from discord.utils import escape_markdown
 from loguru import logger
@@ -16,6 +19,7 @@ from .general import blurple
 from .moderation import GuildNewMember
 import db
 from Components.CustomJoinLeaveMessages import CustomJoinLeaveMessages, format_join_leave, send_log
+from Components.MessageStore import MessageStore
 
 
 async def embed_paginatorinator(content_name, embed, text):
@@ -29,38 +33,187 @@ async def embed_paginatorinator(content_name, embed, text):
     return c_embed
 
 
+class AuditLogCorrelator:
+    """
+    Keeps recent audit log entries delivered over the gateway in a ring buffer indexed by (guild, action, target),
+    so events can be matched to the moderator responsible without fetching the audit log for each one.
+    """
+
+    def __init__(self, size: int = 1000, max_age: float = 300, claim_window: float = 10):
+        self.max_age = max_age
+        self.claim_window = claim_window  # seconds since an entry last changed during which events may claim it
+        self.entries = deque()
+        self.size = size
+        self.index = {}  # (guild_id, action, target_id): [entries], newest last
+        self.waiters = {}  # (guild_id, action, target_id): [futures]
+        self.claims = {}  # entry id: [events claimed from it, monotonic time the entry was last added or updated]
+
+    @staticmethod
+    def key(guild_id, action, target_id):
+        """Returns the index key of an audit log entry"""
+        return guild_id, action, target_id
+
+    @staticmethod
+    def count(entry: discord.AuditLogEntry) -> int:
+        """Returns how many events an entry stands for; message deletes by the same moderator are merged into one entry"""
+        return getattr(entry.extra, 'count', None) or 1
+
+    def add(self, entry: discord.AuditLogEntry):
+        """Stores a new or updated audit log entry and wakes anything waiting for it"""
+        key = self.key(entry.guild.id, entry.action, getattr(entry.target, 'id', None))
+        claim = self.claims.get(entry.id)
+        if claim is not None:
+            # a merged entry whose count went up is sent again with the same id; it replaces the stored one
+            bucket = self.index.get(key, [])
+            if entry in bucket:
+                bucket.remove(entry)
+            claim[1] = time.monotonic()
+        else:
+            if len(self.entries) >= self.size:
+                old_key, old_entry = self.entries.popleft()
+                bucket = self.index.get(old_key)
+                if bucket is not None and old_entry in bucket:
+                    bucket.remove(old_entry)
+                    if not bucket:
+                        del self.index[old_key]
+                self.claims.pop(old_entry.id, None)
+            self.entries.append((key, entry))
+            self.claims[entry.id] = [0, time.monotonic()]
+        self.index.setdefault(key, []).append(entry)
+        for future in self.waiters.pop(key, []):
+            if not future.done():
+                future.set_result(entry)
+
+    def find(self, guild_id, action, target_id, check=None):
+        """Returns the newest recent entry for the action and target that passes `check`, if there is one"""
+        now = discord.utils.utcnow()
+        for entry in reversed(self.index.get(self.key(guild_id, action, target_id), ())):
+            if (now - entry.created_at).total_seconds() > self.max_age:
+                break
+            if check is None or check(entry):
+                return entry
+        return None
+
+    def claim(self, guild_id, action, target_id, check=None):
+        """
+        Like find, but for events that audit log entries count (message deletes): only entries that changed in the last
+        `claim_window` seconds and still have events left over are matched, and the match uses one of them up. This way
+        an entry is never matched to more events than it counts, nor to an unrelated event long after it was made.
+        """
+        now = time.monotonic()
+        for entry in reversed(self.index.get(self.key(guild_id, action, target_id), ())):
+            claim = self.claims[entry.id]
+            if now - claim[1] > self.claim_window or claim[0] >= self.count(entry):
+                continue
+            if check is None or check(entry):
+                claim[0] += 1
+                return entry
+        return None
+
+    async def _wait(self, key, match, timeout: float):
+        """Calls `match` on each new entry for `key` until it returns one, or the timeout passes"""
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.setdefault(key, []).append(future)
+            try:
+                entry = await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                waiters = self.waiters.get(key)
+                if waiters is not None and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self.waiters[key]
+            entry = match(entry)
+            if entry is not None:
+                return entry
+        return None
+
+    async def wait_for(self, guild_id, action, target_id, check=None, timeout: float = 2):
+        """Like find, but waits briefly for the entry to arrive since it may come in after the event it describes"""
+        entry = self.find(guild_id, action, target_id, check)
+        if entry is not None:
+            return entry
+        return await self._wait(self.key(guild_id, action, target_id),
+                                lambda new: new if check is None or check(new) else None, timeout)
+
+    async def wait_to_claim(self, guild_id, action, target_id, check=None, timeout: float = 5):
+        """Like claim, but waits for an entry that arrives or is updated within `timeout` seconds"""
+        return await self._wait(self.key(guild_id, action, target_id),
+                                lambda _: self.claim(guild_id, action, target_id, check), timeout)
+
+
 class Actionlog(Cog):
     """A cog to handle guild events tasks"""
 
+    bulk_delete_delay = 15  # seconds without new bulk delete payloads before a purge is logged
+    bulk_delete_embed_messages = 50  # purges with more cached messages than this are attached as a transcript
+    nickname_lock_cooldown = 10  # minimum seconds between reverting the same member's nickname
+
     def __init__(self, bot: commands.Bot):
         super().__init__(bot)
         self.edit_delete_config = db.ConfigCache(GuildMessageLog)
-        self.bulk_delete_buffer = {}
+        self.bulk_delete_buffer = {}  # channel_id: pending purge, logged once the channel has been quiet
+        self.audit_log = AuditLogCorrelator()
+        self.nickname_locks = None  # (guild_id, member_id): locked name, loaded on first use
+        self.nickname_reverts = {}  # (guild_id, member_id): [time of the last revert, pending timer handle]
+        self.message_store = MessageStore()
+        self.bot.join_pipeline.register_guild_table(CustomJoinLeaveMessages)
+        self.bot.join_pipeline.register_guild_table(GuildNewMember)
+
+    async def cog_unload(self):
+        """Writes out stored messages that are still queued"""
+        self.purge_message_store.cancel()
+        await self.message_store.flush()
+
+    @Cog.listener('on_ready')
+    async def start_message_store_purge(self):
+        """Starts the message store retention task"""
+        if not self.purge_message_store.is_running():
+            self.purge_message_store.start()
+
+    @tasks.loop(hours=1)
+    async def purge_message_store(self):
+        """Deletes stored messages past their guild's retention"""
+        try:
+            await self.message_store.purge()
+        except Exception as e:
+            logger.error(f"Failed to purge the message store: {e}")
+
+    @Cog.listener('on_message')
+    async def on_message(self, message: discord.Message):
+        """Stores messages of guilds that opted in to the message store"""
+        if message.guild is None or message.author.bot or not await self.message_store.enabled(message.guild.id):
+            return
+        self.message_store.store(message.id, message.guild.id, message.channel.id, message.author.id, message.content)
 
-    @staticmethod
-    async def check_audit(guild, event_type, event_time=None):
+    @Cog.listener('on_audit_log_entry_create')
+    async def on_audit_log_entry_create(self, entry: discord.AuditLogEntry):
+        """Stores audit log entries so the other logs can say who performed an action"""
+        self.audit_log.add(entry)
+
+    async def check_audit(self, guild, event_type, target_id, check=None):
         """Method for checking the audit log for events"""
-        try:
-            async for entry in guild.audit_logs(limit=1, after=event_time,
-                                                action=event_type):
-                return entry
-        except discord.Forbidden:
+        if not guild.me.guild_permissions.view_audit_log:
             return None
+        return await self.audit_log.wait_for(guild.id, event_type, target_id, check)
 
-    @Cog.listener('on_member_join')
-    async def on_member_join(self, member):
+    @Cog.listener('on_member_join_state')
+    async def on_member_join(self, member, state):
         """Logs that a member joined, with optional custom message"""
-        join_leave_config = await CustomJoinLeaveMessages.get_by(guild_id=member.guild.id)
-        new_members_config = await GuildNewMember.get_by(guild_id=member.guild.id)
+        join_leave_config = state.get(CustomJoinLeaveMessages)
+        new_members_config = state.get(GuildNewMember)
         if len(new_members_config) == 0 and len(join_leave_config) == 0:
-            await send_log(member)
+            await send_log(member, join_leave_config)
         else:
             if len(new_members_config) > 0 and new_members_config[0].require_team:
                 return
             elif len(join_leave_config) > 0 and join_leave_config[0].send_on_verify:
                 return
             else:
-                await send_log(member)
+                await send_log(member, join_leave_config)
 
     @Cog.listener('on_member_remove')
     async def on_member_remove(self, member):
@@ -87,7 +240,8 @@ class Actionlog(Cog):
 
     async def on_nickname_change(self, before, after):
         """The log handler for when a user changes their nicknames"""
-        audit = await self.check_audit(after.guild, discord.AuditLogAction.member_update)
+        audit = await self.check_audit(after.guild, discord.AuditLogAction.member_update, after.id,
+                                       lambda entry: getattr(entry.after, 'nick', None) == after.nick)
 
         embed = discord.Embed(title="Nickname Changed",
                               color=0x00FFFF)
@@ -96,9 +250,7 @@ class Actionlog(Cog):
         embed.add_field(name="After", value=after.nick, inline=False)
 
         if audit:
-            if audit.target == after:
-                audit_member = await after.guild.fetch_member(audit.user.id)
-                embed.description = f"Nickname Changed By: {audit_member.mention}"
+            embed.description = f"Nickname Changed By: <@{audit.user_id}>"
 
         embed.set_footer(text=f"UserID: {after.id}")
         message_log_channel = await self.edit_delete_config.query_one(guild_id=after.guild.id)
@@ -108,31 +260,63 @@ class Actionlog(Cog):
                 await channel.send(embed=embed)
         await self.check_nickname_lock(before, after)
 
+    @Cog.listener('on_ready')
+    async def load_nickname_locks(self):
+        """Loads every nickname lock into memory."""
+        self.nickname_locks = {(lock.guild_id, lock.member_id): lock.locked_name for lock in await NicknameLock.get_by()}
+
     async def check_nickname_lock(self, before, after):
         """The handler for checking if a member is allowed to change their nickname"""
-        results = await NicknameLock.get_by(guild_id=after.guild.id, member_id=after.id)
-        if results:
-            while time.time() <= results[0].timeout:
-                await asyncio.sleep(10)  # prevents nickname update spam
-
-            if results[0].locked_name != after.display_name:
-                try:
-                    await after.edit(nick=results[0].locked_name)
-                except discord.Forbidden:
-                    return
-                results[0].timeout = time.time() + 10
-                await results[0].update_or_add()
-                await after.send(f"{after.mention}, you do not have nickname change perms in **{after.guild}** "
-                                 f"your nickname has been reverted to **{results[0].locked_name}**")
+        if self.nickname_locks is None:
+            await self.load_nickname_locks()
+        key = (after.guild.id, after.id)
+        locked_name = self.nickname_locks.get(key)
+        if locked_name is None or locked_name == after.display_name:
+            return
+        revert = self.nickname_reverts.get(key)
+        if revert is None:
+            revert = self.nickname_reverts[key] = [0, None]
+        elif revert[1] is not None:
+            return  # a revert is already scheduled and will pick up the latest nickname
+        # prevents nickname update spam
+        delay = max(0, revert[0] + self.nickname_lock_cooldown - time.time())
+        revert[1] = self.bot.loop.call_later(delay, lambda: self.bot.loop.create_task(
+            self.revert_nickname(after.guild, after.id)))
+
+    async def revert_nickname(self, guild, member_id):
+        """Puts a member's locked nickname back"""
+        key = (guild.id, member_id)
+        revert = self.nickname_reverts.get(key)
+        if revert is None:
+            return
+        revert[1] = None
+        locked_name = self.nickname_locks.get(key)
+        member = guild.get_member(member_id)
+        if locked_name is None or member is None or locked_name == member.display_name:
+            return
+        revert[0] = time.time()
+        try:
+            await member.edit(nick=locked_name)
+        except discord.Forbidden:
+            return
+        try:
+            await member.send(f"{member.mention}, you do not have nickname change perms in **{guild}** "
+                              f"your nickname has been reverted to **{locked_name}**")
+        except discord.HTTPException:
+            pass
 
     @Cog.listener()
     async def on_raw_bulk_message_delete(self, payload):
         """Log bulk message deletes"""
+        if payload.guild_id is None:
+            return
         guild = self.bot.get_guild(int(payload.guild_id))
         message_channel = self.bot.get_channel(int(payload.channel_id))
         message_ids = payload.message_ids
         cached_messages = payload.cached_messages
-        if cached_messages[0].author == self.bot.user:
+        if await self.message_store.enabled(guild.id):
+            self.message_store.forget(message_ids)
+        if cached_messages and cached_messages[0].author == self.bot.user:
             return
         message_log_channel = await self.edit_delete_config.query_one(guild_id=guild.id)
         if message_log_channel is not None:
@@ -141,106 +325,131 @@ class Actionlog(Cog):
                 return
         else:
             return
+        # purges arrive as many payloads; collect them and log once the channel has been quiet for a while
         buffer = self.bulk_delete_buffer.get(message_channel.id)
-        if buffer:
-            self.bulk_delete_buffer[message_channel.id]["last_payload"] = time.time()
-            self.bulk_delete_buffer[message_channel.id]["msg_ids"] += message_ids
-            self.bulk_delete_buffer[message_channel.id]["msgs"] += cached_messages
-            header_message = self.bulk_delete_buffer[message_channel.id]["header_message"]
-            header_embed = discord.Embed(title="Bulk Message Delete", color=0xFF0000)
-            deleted = self.bulk_delete_buffer[message_channel.id]["msg_ids"]
-            cached = self.bulk_delete_buffer[message_channel.id]["msgs"]
-            header_embed.description = f"{len(deleted)} Messages Deleted In: {message_channel.mention}\n" \
-                                       f"Messages cached: {len(cached)}/{len(deleted)} \n" \
-                                       f"Messages logged: *Currently Purging*"
-            await header_message.edit(embed=header_embed)
+        if buffer is None:
+            buffer = self.bulk_delete_buffer[message_channel.id] = {"msg_ids": set(), "msgs": {}, "log_channel": channel,
+                                                                    "handle": None}
         else:
-            header_embed = discord.Embed(title="Bulk Message Delete", color=0xFF0000)
-            header_embed.description = f"{len(message_ids)} Messages Deleted In: {message_channel.mention}\n" \
-                                       f"Messages cached: {len(cached_messages)}/{len(message_ids)} \n" \
-                                       f"Messages logged: *Currently Purging*"
-            header_message = await channel.send(embed=header_embed)
+            buffer["handle"].cancel()
+        buffer["msg_ids"].update(message_ids)
+        buffer["msgs"].update((message.id, message) for message in cached_messages)
+        buffer["handle"] = self.bot.loop.call_later(self.bulk_delete_delay, lambda: self.bot.loop.create_task(
+            self.bulk_delete_log(message_channel)))
+
+    @staticmethod
+    def bulk_delete_header(message_channel, deleted, cached, logged):
+        """Builds the summary embed of a bulk delete"""
+        header_embed = discord.Embed(title="Bulk Message Delete", color=0xFF0000)
+        header_embed.description = f"{deleted} Messages Deleted In: {message_channel.mention}\n" \
+                                   f"Messages cached: {cached}/{deleted} \n" \
+                                   f"Messages logged: {logged}"
+        return header_embed
 
-            self.bulk_delete_buffer[message_channel.id] = {"last_payload": time.time(), "msg_ids": list(message_ids),
-                                                           "msgs": list(cached_messages),
-                                                           "log_channel": channel, "header_message": header_message}
+    @staticmethod
+    def bulk_delete_pages(messages, link):
+        """Splits deleted messages into embed pages of at most 25 fields and about 5000 characters each"""
+        pages = []
+        fields = []
+        page_character_count = 0
+        message_count = 0
 
-        await self.bulk_delete_log(message_channel)
+        def finish_page():
+            embed = discord.Embed(title="Bulk Message Delete", color=0xFF0000,
+                                  description=f"Messages {message_count - len(fields) + 1}-{message_count} of "
+                                              f"[bulk delete]({link})",
+                                  timestamp=datetime.datetime.now(tz=datetime.timezone.utc))
+            for name, value in fields:
+                embed.add_field(name=name, value=value, inline=False)
+            embed.set_footer(text=f"Page {len(pages) + 1}")
+            pages.append(embed)
+
+        for message in messages:
+            if not message.content:
+                value = "Message contained no content"
+            elif len(message.content) < 512:
+                value = message.content
+            else:
+                value = f"{message.content[0:512]}..."
+            name = f"{message.created_at.strftime('%b %d %Y %H:%M:%S')}: {message.author}"
+            if fields and (page_character_count + len(name) + len(value) >= 5000 or len(fields) >= 25):
+                finish_page()
+                fields = []
+                page_character_count = 0
+            fields.append((name, value))
+            page_character_count += len(name) + len(value)
+            message_count += 1
+        if fields:
+            finish_page()
+        return pages
+
+    @staticmethod
+    def bulk_delete_transcript(message_channel, message_ids, messages):
+        """Renders every cached deleted message as a gzipped plain text transcript"""
+        lines = [f"Bulk delete in #{message_channel} ({message_channel.id}): {len(message_ids)} messages deleted, "
+                 f"{len(messages)} cached", ""]
+        for message in messages:
+            line = f"[{message.created_at.strftime('%Y-%m-%d %H:%M:%S')}] {message.author} ({message.author.id}): " \
+                   f"{message.content}"
+            if message.attachments:
+                line += " " + " ".join(attachment.proxy_url for attachment in message.attachments)
+            lines.append(line)
+        data = gzip.compress("\n".join(lines).encode("utf-8"))
+        return discord.File(io.BytesIO(data), filename=f"bulk-delete-{message_channel.id}-{int(time.time())}.txt.gz")
 
     async def bulk_delete_log(self, message_channel):
         """Logs a bulk delete after the bot is finished the bulk delete"""
-        buffer_entry = self.bulk_delete_buffer[message_channel.id]
-        await asyncio.sleep(15)
-        if buffer_entry["last_payload"] > time.time() - 15:
+        buffer_entry = self.bulk_delete_buffer.pop(message_channel.id, None)
+        if buffer_entry is None:
             return
-        self.bulk_delete_buffer.pop(message_channel.id)
         message_ids = buffer_entry["msg_ids"]
-        cached_messages = buffer_entry["msgs"]
+        cached_messages = sorted(buffer_entry["msgs"].values(), key=lambda msg: msg.created_at)
         channel = buffer_entry["log_channel"]
-        header_message = buffer_entry["header_message"]
 
-        message_count = 0
-        header_embed = discord.Embed(title="Bulk Message Delete", color=0xFF0000)
-        header_embed.description = f"{len(message_ids)} Messages Deleted In: {message_channel.mention}\n" \
-                                   f"Messages cached: {len(cached_messages)}/{len(message_ids)} \n" \
-                                   f"Messages logged: *Currently Logging*"
-        await header_message.edit(embed=header_embed)
-        link = f"https://discordapp.com/channels/{header_message.guild.id}/{header_message.channel.id}/{header_message.id}"
-        current_page = 1
-        page_character_count = 0
-        page_message_count = 0
-        embed = discord.Embed(title="Bulk Message Delete", color=0xFF0000,
-                              timestamp=datetime.datetime.now(tz=datetime.timezone.utc))
-        for message in sorted(cached_messages, key=lambda msg: msg.created_at):
-            page_character_count += len(message.content[0:512]) + 3
-
-            if page_character_count >= 5000 or page_message_count >= 25:
-                embed.description = f"Messages {message_count}-{message_count + page_message_count} of [bulk delete]({link})"
-                embed.set_footer(text=f"Page {current_page}")
-                current_page += 1
-                try:
-                    await channel.send(embed=embed)
-                except discord.HTTPException as e:
-                    logger.debug(f"Bulk delete embed failed to send: {e}")
-                embed = discord.Embed(title="Bulk Message Delete", color=0xFF0000,
-                                      timestamp=datetime.datetime.now(tz=datetime.timezone.utc))
-                page_character_count = len(message.content)
-                message_count += page_message_count
-                page_message_count = 0
-
-            formatted_time = message.created_at.strftime("%b %d %Y %H:%M:%S")
-            embed.add_field(name=f"{formatted_time}: {message.author}",
-                            value="Message contained no content" if len(
-                                message.content) == 0 else message.content if len(message.content) < 512
-                            else f"{message.content[0:512]}...", inline=False)
-            page_message_count += 1
-            if current_page > 15:
-                break
-        message_count += page_message_count
-        embed.description = f"Messages {message_count}-{message_count + page_message_count} of [bulk delete]({link})"
-        embed.set_footer(text=f"Page {current_page}")
         try:
-            await channel.send(embed=embed)
+            if len(cached_messages) > self.bulk_delete_embed_messages:
+                # large purges are logged as one compressed transcript rather than a stream of embeds
+                header_embed = self.bulk_delete_header(message_channel, len(message_ids), len(cached_messages),
+                                                       f"{len(cached_messages)}/{len(message_ids)} (attached)")
+                await channel.send(embed=header_embed,
+                                   file=self.bulk_delete_transcript(message_channel, message_ids, cached_messages))
+                return
+
+            header_embed = self.bulk_delete_header(message_channel, len(message_ids), len(cached_messages),
+                                                   f"{len(cached_messages)}/{len(message_ids)}")
+            header_message = await channel.send(embed=header_embed)
+            for page in self.bulk_delete_pages(cached_messages, header_message.jump_url):
+                await channel.send(embed=page)
         except discord.HTTPException as e:
-            logger.debug(f"Bulk delete embed failed to send: {e}")
-        header_embed.description = f"{len(message_ids)} Messages Deleted In: {message_channel.mention}\n" \
-                                   f"Messages cached: {len(cached_messages)}/{len(message_ids)} \n" \
-                                   f"Messages logged: {message_count}/{len(message_ids)}"
-        await header_message.edit(embed=header_embed)
+            logger.debug(f"Bulk delete log failed to send: {e}")
 
     @Cog.listener()
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
         """When a message is deleted and its not in the bot cache, log it anyway."""
-        if payload.cached_message:
+        if payload.guild_id is None:
             return
         guild = self.bot.get_guild(int(payload.guild_id))
-        message_channel = self.bot.get_channel(int(payload.channel_id))
         message_id = int(payload.message_id)
+        stored = None
+        if await self.message_store.enabled(guild.id):
+            if not payload.cached_message:
+                stored = await self.message_store.get(message_id)
+            self.message_store.forget([message_id])
+        if payload.cached_message:
+            return
+        message_channel = self.bot.get_channel(int(payload.channel_id))
         message_created = discord.Object(message_id).created_at
         embed = discord.Embed(title="Message Deleted",
                               description=f"Message Deleted In: {message_channel.mention}",
                               color=0xFF00F0, timestamp=message_created)
-        embed.add_field(name="Message", value="N/A", inline=False)
+        if stored is not None:
+            embed.description += f"\nSent by: <@{stored.author_id}>"
+            if stored.content:
+                embed = await embed_paginatorinator("Message", embed, stored.content)
+            else:
+                embed.add_field(name="Message", value="Message contained no content", inline=False)
+        else:
+            embed.add_field(name="Message", value="N/A", inline=False)
         embed.set_footer(text=f"Message ID: {message_channel.id} - {message_id}\nSent at ")
         message_log_channel = await self.edit_delete_config.query_one(guild_id=guild.id)
         if message_log_channel is not None:
@@ -253,15 +462,23 @@ class Actionlog(Cog):
         """When a message is deleted, log it."""
         if message.author == self.bot.user:
             return
-        audit = await self.check_audit(message.guild, discord.AuditLogAction.message_delete, message.created_at)
+        can_audit = message.guild.me.guild_permissions.view_audit_log
+
+        def same_channel(entry):
+            return getattr(entry.extra, 'channel', None) is not None and entry.extra.channel.id == message.channel.id
+
+        # self-deletes have no audit log entry, so the log isn't held back waiting for one: an entry already received
+        # is used now, and one that arrives shortly after is added to the sent log
+        audit = None
+        if can_audit:
+            audit = self.audit_log.claim(message.guild.id, discord.AuditLogAction.message_delete, message.author.id,
+                                         same_channel)
         embed = discord.Embed(title="Message Deleted",
                               description=f"Message Deleted In: {message.channel.mention}\nSent by: {message.author.mention}",
                               color=0xFF0000, timestamp=message.created_at)
         embed.set_author(name=message.author, icon_url=message.author.display_avatar)
         if audit:
-            if audit.target == message.author:
-                audit_member = await message.guild.fetch_member(audit.user.id)
-                embed.add_field(name="Message Deleted By: ", value=str(audit_member.mention), inline=False)
+            embed.add_field(name="Message Deleted By: ", value=f"<@{audit.user_id}>", inline=False)
         if message.content:
             embed = await embed_paginatorinator("Message Content", embed, message.content)
         else:
@@ -270,17 +487,26 @@ class Actionlog(Cog):
         if message.attachments:
             embed.add_field(name="Attachments", value=", ".join([i.proxy_url for i in message.attachments]))
         message_log_channel = await self.edit_delete_config.query_one(guild_id=message.guild.id)
-        if message_log_channel is not None:
-            channel = message.guild.get_channel(message_log_channel.messagelog_channel)
-            if channel is not None:
-                await channel.send(embed=embed)
+        if message_log_channel is None:
+            return
+        channel = message.guild.get_channel(message_log_channel.messagelog_channel)
+        if channel is None:
+            return
+        log_message = await channel.send(embed=embed)
+        if audit or not can_audit:
+            return
+        audit = await self.audit_log.wait_to_claim(message.guild.id, discord.AuditLogAction.message_delete,
+                                                   message.author.id, same_channel)
+        if audit:
+            embed.insert_field_at(0, name="Message Deleted By: ", value=f"<@{audit.user_id}>", inline=False)
+            await log_message.edit(embed=embed)
 
     @Cog.listener()
     async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
         """Logs message edits that are not currently in the bots message cache"""
-        if payload.cached_message:
-            return
         mchannel = self.bot.get_channel(int(payload.channel_id))
+        if mchannel is None or not hasattr(mchannel, 'guild'):
+            return
         guild = mchannel.guild
         try:
             content = payload.data['content']
@@ -289,6 +515,14 @@ class Actionlog(Cog):
         author = payload.data.get("author")
         if not author:
             return
+        stored = None
+        if not author.get('bot') and await self.message_store.enabled(guild.id):
+            if not payload.cached_message:
+                stored = await self.message_store.get(payload.message_id)
+            if content is not None:
+                self.message_store.store(payload.message_id, guild.id, payload.channel_id, int(author['id']), content)
+        if payload.cached_message:
+            return
         guild_id = guild.id
         channel_id = payload.channel_id
         user_id = author['id']
@@ -302,7 +536,10 @@ class Actionlog(Cog):
                               description=f"[MESSAGE]({link}) From {mention}\nEdited In: {mchannel.mention}",
                               color=0xFFC400)
         embed.set_author(name=f"{author['username']}{'#' + author['discriminator'] if author['discriminator'] != '0' else ''}", icon_url=avatar_link)
-        embed.add_field(name="Original", value="N/A", inline=False)
+        if stored is not None and stored.content:
+            embed = await embed_paginatorinator("Original", embed, stored.content)
+        else:
+            embed.add_field(name="Original", value="N/A", inline=False)
         if content:
             embed.add_field(name="Edited", value=content[0:1023], inline=False)
             if len(content) > 1024:
@@ -366,15 +603,14 @@ class Actionlog(Cog):
     @Cog.listener('on_member_ban')
     async def on_member_ban(self, guild: discord.Guild, user: discord.User):
         """Logs raw member ban events, even if not banned via &ban"""
-        audit = await self.check_audit(guild, discord.AuditLogAction.ban)
+        audit = await self.check_audit(guild, discord.AuditLogAction.ban, user.id)
         embed = discord.Embed(title="User Banned", color=0xff6700)
         embed.set_thumbnail(url=user.display_avatar)
         embed.add_field(name="Banned user", value=f"{user}|({user.id})")
-        if audit and audit.target == user:
-            acton_member = await guild.fetch_member(audit.user.id)
-            embed.description = f"User banned by: {acton_member.mention}\n{acton_member}|({acton_member.id})"
+        if audit:
+            embed.description = f"User banned by: <@{audit.user_id}>\n{audit.user}|({audit.user_id})"
             embed.add_field(name="Reason", value=audit.reason, inline=False)
-            embed.set_footer(text=f"Actor ID: {acton_member.id}\nTarget ID: {user.id}")
+            embed.set_footer(text=f"Actor ID: {audit.user_id}\nTarget ID: {user.id}")
         else:
             embed.description = "No audit log entry found"
             embed.set_footer(text=f"Actor ID: Unknown\nTarget ID: {user.id}")
@@ -404,6 +640,28 @@ class Actionlog(Cog):
         `{prefix}messagelogconfig #orwellian-dystopia` - set a channel named #orwellian-dystopia to log message edits/deletions
         """
 
+    @command()
+    @has_permissions(administrator=True)
+    async def messagestore(self, ctx: DozerContext, retention_days: int, max_messages: int = 100000):
+        """Stores message content for this server so edits and deletes of older messages can still be logged. Set the
+        retention to 0 to disable it and delete everything stored."""
+        if retention_days <= 0:
+            await self.message_store.disable(ctx.guild.id)
+            await ctx.send(ctx.message.author.mention + ', message storage disabled and stored messages deleted.')
+            return
+        if retention_days > 30:
+            raise BadArgument("Messages can be stored for at most 30 days")
+        if max_messages <= 0:
+            raise BadArgument("The message limit must be positive")
+        await self.message_store.configure(ctx.guild.id, retention_days, max_messages)
+        await ctx.send(ctx.message.author.mention + f', messages will be stored for {retention_days} days '
+                                                    f'(at most {max_messages} messages).')
+
+    messagestore.example_usage = """
+        `{prefix}messagestore 7` - keep message content for a week so edit/delete logs can show older messages
+        `{prefix}messagestore 0` - stop storing messages and delete everything stored
+        """
+
     @group(invoke_without_command=True)
     @has_permissions(administrator=True)
     async def memberlogconfig(self, ctx: DozerContext):
@@ -570,6 +828,8 @@ class Actionlog(Cog):
             timeout=time.time()
         )
         await lock.update_or_add()
+        if self.nickname_locks is not None:
+            self.nickname_locks[(ctx.guild.id, member.id)] = name
         e = discord.Embed(color=blurple)
         e.add_field(name='Success!', value=f"**{member}**'s nickname has been locked to **{name}**")
         e.set_footer(text='Triggered by ' + escape_markdown(ctx.author.display_name))
@@ -585,6 +845,11 @@ class Actionlog(Cog):
     async def unlocknickname(self, ctx: DozerContext, member: discord.Member):
         """Removes nickname lock from member"""
         deleted = await NicknameLock.delete(guild_id=ctx.guild.id, member_id=member.id)
+        if self.nickname_locks is not None:
+            self.nickname_locks.pop((ctx.guild.id, member.id), None)
+        revert = self.nickname_reverts.pop((ctx.guild.id, member.id), None)
+        if revert is not None and revert[1] is not None:
+            revert[1].cancel()
         if int(deleted.split(" ", 1)[1]):
             e = discord.Embed(color=blurple)
             e.add_field(name='Success!', value=f"Nickname lock for {member} has been removed")
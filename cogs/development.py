@@ -1,6 +1,9 @@
 """Commands specific to development. Only approved developers can use these commands."""
+import asyncio
 import copy
+import datetime
 import re
+import time
 from typing import List
 
 from discord.app_commands.checks import has_permissions
@@ -13,6 +16,8 @@ from discord.ext.commands import NotOwner
 
 import os
 
+import db
+import metrics
 from ._utils import *
 from context import DozerContext
 
@@ -20,6 +25,26 @@ logger = logger.opt(colors = True)
 MY_GUILD = discord.Object(id = 1088700196675919872)  # temp testing server, will switch to ftc discord id later
 
 
+class SyntheticMember:
+    """A stand-in for discord.Member with just what the new member purge uses, for benchmarking it"""
+    __slots__ = ('id', 'joined_at', 'role_ids', 'guild', 'kick_latency')
+
+    def __init__(self, member_id: int, joined_at: datetime.datetime, role_ids: set, guild, kick_latency: float):
+        self.id = member_id
+        self.joined_at = joined_at
+        self.role_ids = role_ids
+        self.guild = guild
+        self.kick_latency = kick_latency
+
+    def get_role(self, role_id: int):
+        """Returns a truthy value if the member has the role"""
+        return role_id if role_id in self.role_ids else None
+
+    async def kick(self, reason: str = None):
+        """Simulates the round trip of a kick request"""
+        await asyncio.sleep(self.kick_latency)
+
+
 class Dropdown(discord.ui.Select):
     """Dropdown menu class to reload cogs using a neat menu"""
     def __init__(self, bot):
@@ -45,7 +70,7 @@ class Dropdown(discord.ui.Select):
         await self.bot.reload_extension(f"cogs.{self.values[0]}")
         # print("reloaded?")
         self.bot.tree.copy_global_to(guild = MY_GUILD)
-        await self.bot.tree.sync(guild = MY_GUILD)
+        await self.bot.sync_commands(MY_GUILD)
         # print("synced?")
         embed = discord.Embed(title = "Reloaded Cog", description = f"Reloaded {self.values[0]}", color = discord.colour.Color.green())
         await interaction.edit_original_response(embed = embed)
@@ -198,7 +223,139 @@ class Development(commands.Cog):
         await paginate_servers(ctx, chunked_data)
 
     listservers.example_usage = """
-    `{prefix}listservers` - display the servers the bot is in. 
+    `{prefix}listservers` - display the servers the bot is in.
+    """
+
+    @commands.hybrid_command()
+    @dev_check()
+    async def synccommands(self, ctx: DozerContext, force: bool = False):
+        """Syncs the app commands of the testing guild and global scope. Unchanged scopes are skipped unless forced,
+        e.g. after commands were changed outside the bot and the saved fingerprints are stale."""
+        self.bot.tree.copy_global_to(guild = MY_GUILD)
+        synced = [scope for scope, guild in (("testing guild", MY_GUILD), ("global", None))
+                  if await self.bot.sync_commands(guild, force = force)]
+        await ctx.send(f"Synced {', '.join(synced)} app commands." if synced else "App commands are unchanged, nothing "
+                       "was synced.", ephemeral = True)
+
+    synccommands.example_usage = """
+    `{prefix}synccommands` - sync app commands that changed since they were last synced
+    `{prefix}synccommands True` - sync every scope, even if it looks unchanged
+    """
+
+    @commands.hybrid_command()
+    @dev_check()
+    async def timers(self, ctx: DozerContext, kind: str = None):
+        """Lists the timers waiting in the bot's scheduler, soonest first."""
+        pending = self.bot.timers.pending(kind)
+        lines = [f"`{entry.kind}` {entry.key} - <t:{int(entry.due)}:R>" for entry in pending] or ["No pending timers."]
+        await self.line_print(ctx, f"Pending timers ({len(pending)})", lines, color = discord.Color.blue())
+
+    timers.example_usage = """
+    `{prefix}timers` - list every pending timer
+    `{prefix}timers punishment` - list pending mute/deafen expirations
+    """
+
+
+    @commands.hybrid_group(name = "metrics", invoke_without_command = True, fallback = "show")
+    @dev_check()
+    async def show_metrics(self, ctx: DozerContext, kind: str = None, sort: str = "sum"):
+        """Shows the slowest listeners, commands, queries and Discord API routes, by total time or by p95/max."""
+        key = {"sum": "sum", "total": "sum", "max": "max", "mean": "mean", "count": "count"}.get(sort)
+        if key is None and sort == "p95":
+            top = sorted(metrics.registry.top(kind, n = len(metrics.registry.histograms)),
+                         key = lambda item: item[2].quantile(0.95), reverse = True)[:15]
+        else:
+            top = metrics.registry.top(kind, n = 15, key = key or "sum")
+        lines = [f"`{metric}` **{label}**: {h.count}x, total {h.sum:.2f}s, mean {h.mean * 1000:.1f}ms, "
+                 f"p95 {h.quantile(0.95) * 1000:.0f}ms, max {h.max * 1000:.0f}ms" for metric, label, h in top]
+        await self.line_print(ctx, f"Slowest {kind or 'handlers'} by {sort}", lines or ["Nothing recorded yet."],
+                              color = discord.Color.blue())
+
+    show_metrics.example_usage = """
+    `{prefix}metrics` - the handlers, queries and API routes with the most total time
+    `{prefix}metrics listener p95` - listeners with the slowest 95th percentile
+    `{prefix}metrics command_db` - commands that spend the most time in the database
+    `{prefix}metrics reset` - drop everything recorded so far
+    """
+
+    @show_metrics.command(name = "reset")
+    @dev_check()
+    async def reset_metrics(self, ctx: DozerContext):
+        """Drops every recorded histogram, e.g. to measure a change from a clean slate."""
+        metrics.registry.reset()
+        await ctx.send("Metrics reset.", ephemeral = True)
+
+    reset_metrics.example_usage = """
+    `{prefix}metrics reset` - drop everything recorded so far
+    """
+
+
+    @commands.hybrid_group(invoke_without_command = True, fallback = "show")
+    @dev_check()
+    async def slowqueries(self, ctx: DozerContext, count: int = 10, recent: bool = False):
+        """Shows the slowest database statements since startup, or the most recent ones over the slow threshold."""
+        traces = list(db.Tracer.slow_log)[-count:][::-1] if recent else db.Tracer.top(count)
+        lines = [f"**{trace.elapsed * 1000:.0f}ms** (waited {trace.wait * 1000:.0f}ms, {trace.rows} rows, "
+                 f"{trace.cog or 'unknown'}, <t:{int(trace.when)}:R>)\n```sql\n{' '.join(trace.query.split())[:300]}\n```"
+                 for trace in traces]
+        await self.line_print(ctx, "Recent slow queries" if recent else "Slowest queries",
+                              lines or ["No queries recorded."], color = discord.Color.blue())
+
+    slowqueries.example_usage = """
+    `{prefix}slowqueries` - the 10 slowest statements since startup
+    `{prefix}slowqueries 5 True` - the 5 most recent statements over the slow query threshold
+    `{prefix}slowqueries reset` - forget every recorded statement
+    """
+
+    @slowqueries.command(name = "reset")
+    @dev_check()
+    async def reset_slowqueries(self, ctx: DozerContext):
+        """Forgets the slowest and recent slow statements recorded so far."""
+        db.Tracer.reset()
+        await ctx.send("Query traces reset.", ephemeral = True)
+
+    reset_slowqueries.example_usage = """
+    `{prefix}slowqueries reset` - forget every recorded statement
+    """
+
+
+    @commands.hybrid_command()
+    @dev_check()
+    async def nmbenchmark(self, ctx: DozerContext, members: int = 50000, kick_latency: float = 0.05,
+                          concurrency: int = 5):
+        """Measures the throughput of the new member purge on a synthetic member list, without touching real members."""
+        moderation = self.bot.get_cog("Moderation")
+        if moderation is None:
+            await ctx.send("The moderation cog isn't loaded.")
+            return
+        now = discord.utils.utcnow()
+        member_role = 1
+        # a third of the members are recent joins, half of the rest picked up the member role; the others get kicked
+        synthetic = [SyntheticMember(i, now - datetime.timedelta(days = 1 if i % 3 == 0 else 30),
+                                     {member_role} if i % 2 == 0 else set(), ctx.guild, kick_latency)
+                     for i in range(members)]
+
+        start = time.perf_counter()
+        candidates = await moderation.nm_purge_candidates(synthetic, member_role, 7, now = now)
+        scan = time.perf_counter() - start
+        # the kick phase sleeps for the simulated latency, so a sample is enough to measure its throughput
+        sample = candidates[:min(len(candidates), concurrency * 20)]
+        start = time.perf_counter()
+        await moderation.nm_purge_kick(sample, concurrency = concurrency)
+        kick = time.perf_counter() - start
+
+        kick_rate = len(sample) / kick if kick else 0
+        lines = [f"Scan: {members} members in {scan * 1000:.1f}ms ({members / scan if scan else 0:,.0f} members/s), "
+                 f"{len(candidates)} candidates",
+                 f"Kick: {len(sample)} kicks in {kick:.2f}s ({kick_rate:.1f} kicks/s at {kick_latency * 1000:.0f}ms "
+                 f"per kick, {concurrency} at a time; "
+                 f"{1 / kick_latency if kick_latency else 0:.1f} kicks/s one at a time)",
+                 f"Estimated full purge: {len(candidates) / kick_rate if kick_rate else 0:.0f}s"]
+        await self.line_print(ctx, "New member purge benchmark", lines, color = discord.Color.blue())
+
+    nmbenchmark.example_usage = """
+    `{prefix}nmbenchmark` - benchmark the purge on 50,000 synthetic members with 50ms kicks
+    `{prefix}nmbenchmark 100000 0.1 10` - 100,000 members, 100ms kicks, 10 kicks at a time
     """
 
 
@@ -5,7 +5,6 @@ from asyncio import sleep
 from datetime import datetime
 from urllib.parse import urljoin, urlencode, quote as urlquote
 import base64
-import imgkit
 import os
 
 import aiohttp
@@ -374,6 +373,7 @@ class FTCInfo(Cog):
             'width': '120',
             'zoom': '2'
         }
+        import imgkit  # imported here since it is only needed by this command
         imgkit.from_url(url, f"{td['teamNumber']}_weather.png", options=options)
         e = discord.Embed(title = f"Current weather for FTC Team {team}:", url = url, description = f"Weather for {td['teamNumber']}: {await data.text()}")
         e.set_image(url = f"attachment://{td['teamNumber']}_weather.png")
@@ -265,7 +265,7 @@ class General(commands.Cog):
             prefix = prefix
         )
         await new_prefix.update_or_add()
-        await self.bot.dynamic_prefix.refresh()
+        self.bot.dynamic_prefix.set_prefix(ctx.guild.id, prefix)
         e = discord.Embed(color = blurple)
         e.add_field(name = 'Success!', value = f"`{ctx.guild}`'s prefix has set to `{prefix}`!")
         e.set_footer(text = 'Triggered by ' + escape_markdown(ctx.author.display_name))
@@ -1,4 +1,6 @@
 # pylint: skip-file
+import asyncio
+from collections import Counter
 from typing import Union
 
 import pytz
@@ -30,11 +32,92 @@ DOOC_MODS = [748927855219703959, 538729840698982409, 761385417068642305]
 FTC_GUILDS = [884664360486703125, 225450307654647808]
 
 
+class InviteTracker:
+    """Keeps invite use counts in memory so joins can be attributed to the invite they used.
+    Joins arriving close together share a single guild.invites() refresh."""
+
+    def __init__(self, guild_ids, window: float = 1.5):
+        self.guild_ids = set(guild_ids)
+        self.window = window
+        self.invites = {}  # guild_id: {code: discord.Invite}
+        self.used_up = {}  # guild_id: [discord.Invite] deleted since the last refresh, probably by hitting max uses
+        self._refreshes = {}  # guild_id: task of the refresh the next joins will wait on
+
+    async def snapshot(self, guild: discord.Guild):
+        """Loads the current invites of a guild."""
+        try:
+            self.invites[guild.id] = {invite.code: invite for invite in await guild.invites()}
+        except discord.HTTPException as e:
+            logger.warning(f"Couldn't snapshot invites of {guild}: {e}")
+
+    def invite_created(self, invite: discord.Invite):
+        if invite.guild is not None and invite.guild.id in self.invites:
+            self.invites[invite.guild.id][invite.code] = invite
+
+    def invite_deleted(self, invite: discord.Invite):
+        if invite.guild is None or invite.guild.id not in self.invites:
+            return
+        old = self.invites[invite.guild.id].pop(invite.code, None)
+        if old is not None and old.max_uses and old.uses + 1 >= old.max_uses:
+            self.used_up.setdefault(invite.guild.id, []).append(old)
+
+    async def _refresh(self, guild: discord.Guild):
+        """Fetches the guild's invites once and returns how many new uses each invite got since the last refresh."""
+        await asyncio.sleep(self.window)
+        # joins from here on wait for the next refresh, since this fetch may not include them
+        self._refreshes.pop(guild.id, None)
+        old = self.invites.get(guild.id, {})
+        try:
+            current = {invite.code: invite for invite in await guild.invites()}
+        except discord.HTTPException as e:
+            logger.warning(f"Couldn't refresh invites of {guild}: {e}")
+            return Counter(), {}
+        used = Counter({code: invite.uses - (old[code].uses if code in old else 0)
+                        for code, invite in current.items() if invite.uses > (old[code].uses if code in old else 0)})
+        used_up = self.used_up.pop(guild.id, [])
+        for invite in used_up:
+            used[invite.code] += 1
+        self.invites[guild.id] = current
+        return used, {**{invite.code: invite for invite in used_up}, **current}
+
+    async def attribute(self, member: discord.Member):
+        """Returns the invite a member most likely joined with, or None if it couldn't be determined."""
+        guild = member.guild
+        if guild.id not in self.invites:
+            return None
+        task = self._refreshes.get(guild.id)
+        if task is None:
+            task = self._refreshes[guild.id] = asyncio.create_task(self._refresh(guild))
+        used, invites = await asyncio.shield(task)
+        # members of the same burst share the counter, so each use is only handed out once
+        for code, count in used.most_common():
+            if count > 0:
+                used[code] -= 1
+                return invites.get(code)
+        return None
+
+
 class Hacks(Cog):
     def __init__(self, bot: commands.Bot) -> None:
         super().__init__(bot)
         self.bot = bot
         self.config = self.bot.config
+        self.invite_tracker = InviteTracker([FTC_DISCORD_ID])
+
+    @Cog.listener()
+    async def on_ready(self):
+        for guild_id in self.invite_tracker.guild_ids:
+            guild = self.bot.get_guild(guild_id)
+            if guild is not None and guild.me.guild_permissions.manage_guild:
+                await self.invite_tracker.snapshot(guild)
+
+    @Cog.listener()
+    async def on_invite_create(self, invite):
+        self.invite_tracker.invite_created(invite)
+
+    @Cog.listener()
+    async def on_invite_delete(self, invite):
+        self.invite_tracker.invite_deleted(invite)
 
     @Cog.listener()
     async def on_guild_join(self, guild):
@@ -52,9 +135,12 @@ class Hacks(Cog):
         else:
             return
         logs = self.bot.get_channel(JOINED_LOGS_ID)
-        res = f"```New user {member} ({member.id})\nInvite summary:\n"
-        for i in await member.guild.invites():
-            res += f"{i.code}, {i.uses}\n"
+        invite = await self.invite_tracker.attribute(member)
+        res = f"```New user {member} ({member.id})\n"
+        if invite is not None:
+            res += f"Invite: {invite.code} by {invite.inviter} ({invite.uses} uses)\n"
+        else:
+            res += "Invite: unknown\n"
         res += "```"
         await logs.send(res)
 
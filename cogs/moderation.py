@@ -50,29 +50,85 @@ class Moderation(Cog):
     def __init__(self, bot: commands.Bot):
         super().__init__(bot)
         self.links_config = db.ConfigCache(GuildMessageLinks)
-        self.punishment_timer_tasks = []
+        self.bot.timers.register("punishment", self.punishment_expired)
+        self.bot.join_pipeline.register_member_table(Mute)
+        self.bot.join_pipeline.register_member_table(Deafen)
 
     """=== Helper functions ==="""
 
-    async def nm_kick_internal(self, guild: discord.Guild = None):
-        """Kicks people who have not done the new member process within a set amount of time."""
+    @staticmethod
+    async def nm_purge_candidates(members: typing.Iterable[discord.Member], member_role_id: int, days: int,
+                                  now: datetime.datetime = None, yield_every: int = 1000):
+        """
+        Phase one of the new member purge: a single pass over `members` that returns everyone who joined at least `days`
+        days ago without picking up the member role. Yields to the event loop every `yield_every` members.
+        """
+        cutoff = (now or discord.utils.utcnow()) - datetime.timedelta(days = days)
+        candidates = []
+        for i, mem in enumerate(members):
+            if i % yield_every == yield_every - 1:
+                await asyncio.sleep(0)
+            if mem.joined_at is not None and mem.joined_at <= cutoff and mem.get_role(member_role_id) is None:
+                candidates.append(mem)
+        return candidates
+
+    async def nm_purge_kick(self, candidates: typing.List[discord.Member], concurrency: int = 5, progress = None):
+        """
+        Phase two of the new member purge: kicks the candidates, at most `concurrency` at a time. `progress`, if given,
+        is called (or awaited) with (done, total) after every kick. Returns the members that were actually kicked.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        total = len(candidates)
+        kicked = []
+        done = 0
+
+        async def kick(mem):
+            nonlocal done
+            async with semaphore:
+                try:
+                    await mem.kick(reason = "New member purge cycle")
+                    kicked.append(mem)
+                except discord.HTTPException as e:
+                    logger.warning(f"Failed to kick {mem} ({mem.id}) from {mem.guild} during new member purge: {e}")
+            done += 1
+            if done % 50 == 0 or done == total:
+                logger.debug(f"New member purge in {mem.guild}: {done}/{total} processed")
+            if progress is not None:
+                result = progress(done, total)
+                if asyncio.iscoroutine(result):
+                    await result
+
+        await asyncio.gather(*(kick(mem) for mem in candidates))
+        return kicked
+
+    async def nm_kick_internal(self, guild: discord.Guild = None, dry_run: bool = False, progress = None):
+        """
+        Kicks people who have not done the new member process within a set amount of time.
+        With `dry_run`, nobody is kicked and the members that would have been are returned instead.
+        Returns the list of kicked (or, with `dry_run`, to-be-kicked) members.
+        """
         logger.debug("Starting nm_kick cycle...")
         if not guild:
             entries = await NewMemPurgeConfig.get_by()
         else:
             entries = await NewMemPurgeConfig.get_by(guild_id = guild.id)
-        count = 0
+        purged = []
         for entry in entries:
             guild = self.bot.get_guild(entry.guild_id)
             if guild is None:
                 continue
-            for mem in guild.members:
-                if guild.get_role(entry.member_role) not in mem.roles:
-                    delta = datetime.datetime.now() - mem.joined_at
-                    if delta.days >= entry.days:
-                        await mem.kick(reason = "New member purge cycle")
-                        count += 1
-        return count
+            if guild.get_role(entry.member_role) is None:
+                logger.warning(f"Member role {entry.member_role} of {guild} no longer exists, skipping new member purge")
+                continue
+            start = time.perf_counter()
+            candidates = await self.nm_purge_candidates(guild.members, entry.member_role, entry.days)
+            logger.debug(f"Scanned {guild.member_count} members of {guild} in {time.perf_counter() - start:.3f}s, "
+                         f"{len(candidates)} to purge")
+            if dry_run:
+                purged.extend(candidates)
+            else:
+                purged.extend(await self.nm_purge_kick(candidates, progress = progress))
+        return purged
 
     @discord.ext.tasks.loop(hours = 168)
     async def nm_kick(self):
@@ -152,22 +208,43 @@ class Moderation(Cog):
                 await orig_channel.send("Please configure modlog channel to enable modlog functionality",
                                         ephemeral = True)
 
-    async def perm_override(self, member: discord.Member, **overwrites):
-        """Applies the given overrides to the given member in their guild."""
-        logger.debug(f"Applying overrides to {member} ({member.id})")
-        overwrite_count = 0
-        guild = await self.bot.fetch_guild(member.guild.id)
-        channels = await guild.fetch_channels()
-        # For some reason guild.me is returning None only sometimes, so this is a workaround to get perm_overrides working
-        me = await guild.fetch_member(self.bot.user.id)
-        for channel in channels:
-            overwrite = channel.overwrites_for(member)
-            if channel.permissions_for(me).manage_roles:
-                overwrite.update(**overwrites)
+    async def perm_override(self, member: discord.Member, *, concurrency: int = 5, **overwrites):
+        """
+        Applies the given overrides to the given member in their guild.
+        Channels are read from the cache, and channels whose overwrite would not change are skipped entirely. The
+        remaining edits run concurrently, at most `concurrency` at a time; discord.py still enforces the per-route rate
+        limits for us. Progress is logged every 50 edits.
+        Returns a tuple of (applied, total) overwrite edits.
+        """
+        guild = member.guild
+        # guild.me can be None if the bot's member isn't cached yet, so fall back to fetching it
+        me = guild.me or await guild.fetch_member(self.bot.user.id)
+        changes = []
+        for channel in guild.channels:
+            current = channel.overwrites_for(member)
+            desired = discord.PermissionOverwrite.from_pair(*current.pair())
+            desired.update(**overwrites)
+            if desired == current:
+                continue
+            if not channel.permissions_for(me).manage_roles:
+                logger.warning(f"Missing permissions to manage roles in {channel} ({channel.id})")
+                continue
+            changes.append((channel, desired))
+
+        total = len(changes)
+        logger.debug(f"Applying {total} overrides to {member} ({member.id}), "
+                     f"{len(guild.channels) - total} channels unchanged or skipped")
+        semaphore = asyncio.Semaphore(concurrency)
+        done = 0
+        applied = 0
+
+        async def apply(channel, overwrite):
+            nonlocal done, applied
+            async with semaphore:
                 try:
                     await channel.set_permissions(target = member,
                                                   overwrite = None if overwrite.is_empty() else overwrite)
-                    overwrite_count += 1
+                    applied += 1
                 except discord.Forbidden as e:
                     logger.error(
                         f"Failed to catch missing perms in {channel} ({channel.id}) Guild: {channel.guild.id}; Error: {e}")
@@ -177,9 +254,13 @@ class Moderation(Cog):
                         f"{channel} ({channel.id}) Guild: {channel.guild.id}; Error: {e}")
                 except Exception as e:
                     logger.error(f"Failed to catch some unknown or unexpected error: {e}")
-            else:
-                logger.warning(f"Missing permissions to manage roles in {channel} ({channel.id})")
-        logger.debug(f"Applied {overwrite_count}/({len(channels)}) overrides to {member} ({member.id})")
+            done += 1
+            if done % 50 == 0 and done != total:
+                logger.debug(f"Overrides for {member} ({member.id}) in {guild}: {done}/{total} processed")
+
+        await asyncio.gather(*(apply(channel, overwrite) for channel, overwrite in changes))
+        logger.debug(f"Applied {applied}/{total} overrides to {member} ({member.id})")
+        return applied, total
 
     hm_regex = re.compile(
         r"((?P<years>\d+)y)?((?P<months>\d+)M)?((?P<weeks>\d+)w)?((?P<days>\d+)d)?((?P<hours>\d+)h)?((?P<minutes>\d+)m)?(("
@@ -201,54 +282,60 @@ class Moderation(Cog):
         return max(0, min(2147483647, val))
 
     async def start_punishment_timers(self):
-        """Starts all punishment timers"""
-        q = await PunishmentTimerRecords.get_by()  # no filters: all
-        for r in q:
-            try:
-                guild = await self.bot.fetch_guild(r.guild_id)
-            except discord.NotFound:
-                logger.warning(f"Guild {r.guild_id} not found, skipping punishment timer")
-                continue
-            try:
-                actor = await guild.fetch_member(r.actor_id)
-            except discord.NotFound:
-                actor = None
-            try:
-                target = await guild.fetch_member(r.target_id)
-            except discord.NotFound:
-                logger.warning(f"Target {r.target_id} not found, skipping punishment timer")
-                continue
-            orig_channel = self.bot.get_channel(r.orig_channel_id)
-            punishment_type = r.type_of_punishment
-            reason = r.reason or ""
-            seconds = max(int(r.target_ts - time.time()), 0.01)
-            # await PunishmentTimerRecords.delete(id=r.id)
-            self.bot.loop.create_task(
-                self.punishment_timer(seconds, target, PunishmentTimerRecords.type_map[punishment_type], reason, actor,
-                                      orig_channel, timer_id = r.id))
-            logger.info(
-                f"Restarted {PunishmentTimerRecords.type_map[punishment_type].__name__} of {target} in {guild}")
+        """
+        Restores all punishment timers from the database.
+        Guilds and members are resolved from the gateway cache, and only the misses are requested, in batched member
+        queries with bounded concurrency. Timers are keyed, so calling this again (e.g. on reconnect) never duplicates them.
+        """
+        records = await PunishmentTimerRecords.get_by()  # no filters: all
+        by_guild = {}
+        for r in records:
+            by_guild.setdefault(r.guild_id, []).append(r)
+
+        semaphore = asyncio.Semaphore(4)
+        restored = 0
+
+        async def restore_guild(guild_id, guild_records):
+            nonlocal restored
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                logger.warning(f"Guild {guild_id} not found, skipping {len(guild_records)} punishment timer(s)")
+                return
+            missing = list({r.target_id for r in guild_records if guild.get_member(r.target_id) is None})
+            if missing:
+                async with semaphore:
+                    for i in range(0, len(missing), 100):  # the gateway accepts up to 100 user ids per query
+                        try:
+                            await guild.query_members(user_ids = missing[i:i + 100], limit = 100, cache = True)
+                        except asyncio.TimeoutError:
+                            logger.warning(f"Timed out querying {len(missing[i:i + 100])} members of {guild}")
+            for r in guild_records:
+                target = guild.get_member(r.target_id)
+                if target is None:
+                    logger.warning(f"Target {r.target_id} not found, skipping punishment timer")
+                    continue
+                key = (r.guild_id, r.target_id, r.type_of_punishment)
+                pending = self.bot.timers.get("punishment", key)
+                if pending is not None and pending.due == r.target_ts:
+                    continue  # already scheduled by an earlier on_ready
+                self.bot.timers.schedule("punishment", key, r.target_ts, r)
+                restored += 1
+                logger.debug(f"Restarted {PunishmentTimerRecords.type_map[r.type_of_punishment].__name__} "
+                             f"of {target} in {guild}")
+
+        await asyncio.gather(*(restore_guild(guild_id, recs) for guild_id, recs in by_guild.items()))
+        logger.info(f"Restored {restored} of {len(records)} punishment timers")
 
     async def restart_all_timers(self):
         """Restarts all timers"""
         logger.info("Restarting all timers")
-        for timer in self.punishment_timer_tasks:
-            # timer: asyncio.Task
-            logger.info(f"Stopping \"{timer.get_name()}\"")
-        for timer in self.punishment_timer_tasks:
-            timer.cancel()
-        self.punishment_timer_tasks = []
+        self.bot.timers.cancel_all("punishment")
         await self.start_punishment_timers()
 
     async def punishment_timer(self, seconds: int, target: discord.Member, punishment, reason: str,
                                actor: discord.Member, orig_channel = None,
-                               global_modlog: bool = True, timer_id: int = None):
-        """Asynchronous task that sleeps for a set time to unmute/undeafen a member for a set period of time."""
-
-        # Add this task to the list of active timer tasks
-        asyncio.current_task().set_name(f"PunishmentTimer for {target}")
-        self.punishment_timer_tasks.append(asyncio.current_task())
-
+                               global_modlog: bool = True):
+        """Registers a timer to unmute/undeafen a member after a set period of time."""
         logger.info(
             f"Starting{' self' if not global_modlog else ''} {punishment.__name__} timer of \"{target}\" in \"{target.guild}\" will "
             f"expire in {seconds} seconds")
@@ -256,46 +343,61 @@ class Moderation(Cog):
         if seconds == 0:
             return
 
-        if timer_id is None:
-            # register the timer
-            ent = PunishmentTimerRecords(
-                guild_id = target.guild.id,
-                actor_id = actor.id,
-                target_id = target.id,
-                orig_channel_id = orig_channel.id if orig_channel else 0,
-                type_of_punishment = punishment.type,
-                reason = reason,
-                target_ts = int(seconds + time.time()),
-                self_inflicted = not global_modlog
-            )
-            await ent.update_or_add()
-        else:
-            ent = (await PunishmentTimerRecords.get_by(id = timer_id))[0]
-            # seconds = max(int(ent.target_ts - time.time()), 0.01)
-
-        await asyncio.sleep(seconds)
+        ent = PunishmentTimerRecords(
+            guild_id = target.guild.id,
+            actor_id = actor.id,
+            target_id = target.id,
+            orig_channel_id = orig_channel.id if orig_channel else 0,
+            type_of_punishment = punishment.type,
+            reason = reason,
+            target_ts = int(seconds + time.time()),
+            self_inflicted = not global_modlog
+        )
+        await ent.update_or_add_later()
+        self.bot.timers.schedule("punishment", (target.guild.id, target.id, punishment.type), ent.target_ts, ent)
+
+    def cancel_punishment_timer(self, member: discord.Member, punishment):
+        """Cancels the pending timer of a punishment, if there is one. The stored record is left to the caller."""
+        self.bot.timers.cancel("punishment", (member.guild.id, member.id, punishment.type))
+
+    async def punishment_expired(self, entry):
+        """Called by the timer scheduler when a punishment timer expires; performs the un-punishment."""
+        record = entry.payload
+        punishment = PunishmentTimerRecords.type_map[record.type_of_punishment]
+        global_modlog = not record.self_inflicted
+        guild = self.bot.get_guild(record.guild_id)
+        if guild is None:
+            logger.warning(f"Guild {record.guild_id} not found, skipping un-punishment")
+            return
+        target = guild.get_member(record.target_id)
+        if target is None:
+            try:
+                target = await guild.fetch_member(record.target_id)
+            except discord.NotFound:
+                logger.warning(f"Target {record.target_id} not found, skipping un-punishment")
+                return
+        actor = guild.get_member(record.actor_id) or guild.me
+        orig_channel = self.bot.get_channel(record.orig_channel_id)
         logger.info(f"Finished{' self' if not global_modlog else ''} {punishment.__name__} "
                     f"timer of \"{target}\" in \"{target.guild}\", preforming un-punishment")
 
-        user = await punishment.get_by(member_id = target.id)
+        user = await punishment.get_by(guild_id = guild.id, member_id = target.id)
         try:
             if len(user) != 0:
                 await self.mod_log(actor = actor,
                                    action = "un" + punishment.past_participle,
                                    target = target,
-                                   reason = reason,
+                                   reason = record.reason or "",
                                    orig_channel = orig_channel,
                                    embed_color = discord.Color.green(),
                                    global_modlog = global_modlog)
-                self.punishment_timer_tasks.remove(asyncio.current_task())
                 self.bot.loop.create_task(coro = punishment.finished_callback(self, target))
             else:
                 logger.warning(
                     f"User {target} was not found in the {punishment.__name__} database, skipping un-punishment")
 
-            if ent:
-                await PunishmentTimerRecords.delete(guild_id = target.guild.id, target_id = target.id,
-                                                    type_of_punishment = punishment.type)
+            await PunishmentTimerRecords.delete(guild_id = guild.id, target_id = target.id,
+                                                type_of_punishment = punishment.type)
         except Exception as e:
             logger.error(f"Error while un-punishing {target} in {target.guild}, {e}")
             logger.exception(e)
@@ -363,10 +465,9 @@ class Moderation(Cog):
         if results:
             await PunishmentTimerRecords.delete(target_id = member.id, guild_id = member.guild.id,
                                                 type_of_punishment = Mute.type)
-            await self.restart_all_timers()
-            self.bot.loop.create_task(
-                self.punishment_timer(seconds, member, Mute, reason, actor or member.guild.me,
-                                      orig_channel = orig_channel))
+            self.cancel_punishment_timer(member, Mute)
+            await self.punishment_timer(seconds, member, Mute, reason, actor or member.guild.me,
+                                        orig_channel = orig_channel)
             await member.timeout(datetime.timedelta(seconds = seconds))
             return False  # member already muted, edit preexisting record
         else:
@@ -377,9 +478,8 @@ class Moderation(Cog):
             if seconds == 0:
                 seconds = 28 * 24 * 3600 - 60  # discord max is 28 days, minus 1 second
             await member.timeout(datetime.timedelta(seconds = seconds), reason = reason)
-            self.bot.loop.create_task(
-                self.punishment_timer(seconds, member, Mute, reason, actor or member.guild.me,
-                                      orig_channel = orig_channel))
+            await self.punishment_timer(seconds, member, Mute, reason, actor or member.guild.me,
+                                        orig_channel = orig_channel)
             return True
 
     async def _unmute(self, member: discord.Member):
@@ -392,7 +492,7 @@ class Moderation(Cog):
             # await self.perm_override(member, send_messages=None, add_reactions=None, speak=None, stream=None,
             #                         create_public_threads=None, create_private_threads=None)
             await member.timeout(datetime.timedelta(seconds = 0))
-            await self.restart_all_timers()
+            self.cancel_punishment_timer(member, Mute)
             return True
         else:
             return False  # member not muted
@@ -421,14 +521,13 @@ class Moderation(Cog):
             await PunishmentTimerRecords.delete(target_id = member.id, guild_id = member.guild.id,
                                                 type_of_punishment = Deafen.type)
 
-            await self.restart_all_timers()
-            self.bot.loop.create_task(
-                self.punishment_timer(seconds, member,
-                                      Deafen,
-                                      reason,
-                                      actor or member.guild.me,
-                                      orig_channel = orig_channel,
-                                      global_modlog = not self_inflicted))
+            self.cancel_punishment_timer(member, Deafen)
+            await self.punishment_timer(seconds, member,
+                                        Deafen,
+                                        reason,
+                                        actor or member.guild.me,
+                                        orig_channel = orig_channel,
+                                        global_modlog = not self_inflicted)
             return False
         else:
             user = Deafen(member_id = member.id, guild_id = member.guild.id, self_inflicted = self_inflicted)
@@ -442,13 +541,12 @@ class Moderation(Cog):
                     await PausedRole(guild_id = member.guild.id, member_id = member.id, paused_role_id = role).add()
             if self_inflicted and seconds == 0:
                 seconds = 30  # prevent lockout in case of bad argument
-            self.bot.loop.create_task(
-                self.punishment_timer(seconds, member,
-                                      punishment = Deafen,
-                                      reason = reason,
-                                      actor = actor or member.guild.me,
-                                      orig_channel = orig_channel,
-                                      global_modlog = not self_inflicted))
+            await self.punishment_timer(seconds, member,
+                                        punishment = Deafen,
+                                        reason = reason,
+                                        actor = actor or member.guild.me,
+                                        orig_channel = orig_channel,
+                                        global_modlog = not self_inflicted)
             return True
 
     async def _undeafen(self, member: discord.Member):
@@ -466,7 +564,7 @@ class Moderation(Cog):
             await member.edit(roles = roles)
             await PunishmentTimerRecords.delete(target_id = member.id, guild_id = member.guild.id,
                                                 type_of_punishment = Deafen.type)
-            await self.restart_all_timers()
+            self.cancel_punishment_timer(member, Deafen)
             await PausedRole.delete(member_id = member.id, guild_id = member.guild.id)
             await Deafen.delete(member_id = member.id, guild_id = member.guild.id)
             truths = [True, results[0].self_inflicted]
@@ -480,16 +578,15 @@ class Moderation(Cog):
     async def on_ready(self):
         """Restore punishment timers on bot startup and trigger the nm purge cycle"""
         await self.start_punishment_timers()
-        await self.nm_kick.start()
+        if not self.nm_kick.is_running():
+            self.nm_kick.start()
 
-    @Cog.listener('on_member_join')
-    async def on_member_join(self, member: discord.Member):
-        """Logs that a member joined."""
-        users = await Mute.get_by(guild_id = member.guild.id, member_id = member.id)
-        if users:
+    @Cog.listener('on_member_join_state')
+    async def on_member_join(self, member: discord.Member, state):
+        """Reapplies mutes and deafens to members that rejoin."""
+        if state.get(Mute):
             await self.perm_override(member, add_reactions = False, send_messages = False)
-        users = await Deafen.get_by(guild_id = member.guild.id, member_id = member.id)
-        if users:
+        if state.get(Deafen):
             await self.perm_override(member, read_messages = False)
 
     @Cog.listener('on_message')
@@ -900,10 +997,24 @@ class Moderation(Cog):
     @has_permissions(kick_members = True)
     @bot_has_permissions(kick_members = True)
     @commands.hybrid_command()
-    async def purgenm(self, ctx: DozerContext):
+    @app_commands.describe(preview = "List who would be kicked without kicking anyone")
+    async def purgenm(self, ctx: DozerContext, preview: bool = False):
         """Manually run a new member purge"""
-        memcount = await self.nm_kick_internal(guild = ctx.guild)
-        await ctx.send(f"Kicked {memcount} members due to inactivity!")
+        if preview:
+            members = await self.nm_kick_internal(guild = ctx.guild, dry_run = True)
+            names = "\n".join(f"{escape_markdown(str(mem))} ({mem.id})" for mem in members[:20])
+            if len(members) > 20:
+                names += f"\n...and {len(members) - 20} more"
+            await ctx.send(f"{len(members)} members would be kicked due to inactivity." + (f"\n{names}" if names else ""))
+            return
+        async with ctx.typing():
+            members = await self.nm_kick_internal(guild = ctx.guild)
+        await ctx.send(f"Kicked {len(members)} members due to inactivity!")
+
+    purgenm.example_usage = """
+    `{prefix}purgenm` - kick every member who hasn't completed the new member process in time
+    `{prefix}purgenm True` - list the members that would be kicked, without kicking them
+    """
 
     """=== Configuration commands ==="""
 
@@ -13,6 +13,7 @@ class Nicknames(commands.Cog):
 
     def __init__(self, bot: commands.Bot) -> None:
         self.bot = bot
+        bot.join_pipeline.register_member_table(NicknameTable, member_column = "user_id")
 
     @commands.hybrid_command()
     @guild_only()
@@ -35,11 +36,11 @@ class Nicknames(commands.Cog):
     `{prefix}savenick False` - disables saving nicknames upon server leave.
     """
 
-    @Cog.listener()
-    async def on_member_join(self, member):
+    @Cog.listener('on_member_join_state')
+    async def on_member_join(self, member, state):
         """Handles adding the nickname back on server join."""
-        nick = await NicknameTable.get_by(user_id = member.id, guild_id = member.guild.id)
-        if not nick or not nick[0].enabled or not member.guild.me.guild_permissions.manage_nicknames or member.top_role >= member.guild.me.top_role:
+        nick = state.get(NicknameTable)
+        if not nick or not nick[0].enabled or not nick[0].nickname or not member.guild.me.guild_permissions.manage_nicknames or member.top_role >= member.guild.me.top_role:
             return
         await member.edit(nick = nick[0].nickname)
 
@@ -47,15 +48,17 @@ class Nicknames(commands.Cog):
     async def on_member_remove(self, member):
         """Handles saving the nickname on server leave."""
         nick = await NicknameTable.get_by(user_id = member.id, guild_id = member.guild.id)
-        if nick is None:
+        if not nick:
+            if member.nick is None:
+                return
             nick = NicknameTable(user_id = member.id, guild_id = member.guild.id, nickname = member.nick,
                                  enabled = True)
-            await nick.update_or_add()
+            await nick.update_or_add_later()
         else:
             if not nick[0].enabled:
                 return
-            nick[0].nickname = member.nick
-            await nick[0].update_or_add()
+            nick[0].nickname = member.nick or ''  # the column is NOT NULL, an empty name means no nickname
+            await nick[0].update_or_add_later()
 
 
 class NicknameTable(db.DatabaseTable):
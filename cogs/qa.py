@@ -8,7 +8,6 @@ from typing import Union
 import aiohttp
 
 from ._utils import *
-from bs4 import BeautifulSoup
 
 
 async def data(ctx: DozerContext, level: str, question: int) -> Union[str, None]:
@@ -24,6 +23,7 @@ async def data(ctx: DozerContext, level: str, question: int) -> Union[str, None]
     else:
         return None
 
+    from bs4 import BeautifulSoup  # bs4 is slow to import and only needed here
     answers = BeautifulSoup(html_data, 'html.parser').get_text()
 
     start = answers.find(f'Q{question} ')
@@ -1,5 +1,6 @@
 """Role management commands."""
 import asyncio
+import bisect
 import time
 import typing
 import discord
@@ -10,7 +11,7 @@ from discord import app_commands
 from discord.ext import commands
 
 import db
-from Components import CustomJoinLeaveMessages
+from Components.CustomJoinLeaveMessages import CustomJoinLeaveMessages
 from context import DozerContext
 from ._utils import *
 from loguru import logger
@@ -20,11 +21,58 @@ from .moderation import MemberRole
 blurple = discord.Color.blurple()
 
 
+class GiveableRoleIndex:
+    """In-memory index of one guild's giveable roles, by role id and by normalized name."""
+
+    def __init__(self, records = ()):
+        self.by_id = {record.role_id: record for record in records}
+        self._sorted_names = None  # sorted (norm_name, name) pairs for prefix search, rebuilt lazily after changes
+
+    def add(self, record):
+        """Adds or replaces a giveable role."""
+        self.by_id[record.role_id] = record
+        self._sorted_names = None
+
+    def remove(self, role_id: int):
+        """Removes a giveable role, if present."""
+        if self.by_id.pop(role_id, None) is not None:
+            self._sorted_names = None
+
+    def remove_name(self, norm_name: str):
+        """Removes every giveable role with the given normalized name."""
+        for record in self.find([norm_name]):
+            self.remove(record.role_id)
+
+    def find(self, norm_names):
+        """Returns the giveable roles whose normalized name is in `norm_names`."""
+        norm_names = set(norm_names)
+        return [record for record in self.by_id.values() if record.norm_name in norm_names]
+
+    def prefix_search(self, prefix: str, limit: int = 25):
+        """Returns up to `limit` role names whose normalized name starts with the normalized `prefix`."""
+        if self._sorted_names is None:
+            self._sorted_names = sorted((record.norm_name, record.name) for record in self.by_id.values())
+        names = []
+        i = bisect.bisect_left(self._sorted_names, (prefix,))
+        while i < len(self._sorted_names) and len(names) < limit and self._sorted_names[i][0].startswith(prefix):
+            names.append(self._sorted_names[i][1])
+            i += 1
+        return names
+
+
 class Roles(Cog):
     """Commands for role management."""
 
     def __init__(self, bot: commands.Bot):
         super().__init__(bot)
+        self.bot.timers.register("temprole", self.removal_timer)
+        self.reaction_index = {}  # message_id: {reaction: role_id} for every message with reaction roles
+        self.menu_ids = set()  # message ids of role menus
+        self.reaction_index_loaded = False
+        self.giveable_indexes = {}  # guild_id: GiveableRoleIndex, loaded on first use
+        self.bot.join_pipeline.register_member_table(MissingRole)
+        self.bot.join_pipeline.register_guild_table(MemberRole)
+        self.bot.join_pipeline.register_guild_table(CustomJoinLeaveMessages)
         for loop_command in self.giveme.walk_commands():
             @loop_command.before_invoke  # pylint: disable=cell-var-from-loop
             async def givemeautopurge(self, ctx: DozerContext):
@@ -69,17 +117,70 @@ class Roles(Cog):
 
     @Cog.listener('on_ready')
     async def on_ready(self):
-        """Restore tempRole timers on bot startup"""
+        """Restore tempRole timers and the reaction role index on bot startup"""
         q = await TempRoleTimerRecords.get_by()  # no filters: all
         for record in q:
-            self.bot.loop.create_task(self.removal_timer(record))
+            self.schedule_removal(record)
+        await self.load_reaction_index()
+
+    async def load_reaction_index(self):
+        """Loads every reaction role and role menu into the in-memory index used by the reaction handlers."""
+        reaction_index = {}
+        for entry in await ReactionRole.get_by():
+            reaction_index.setdefault(entry.message_id, {}).setdefault(entry.reaction, entry.role_id)
+        self.reaction_index = reaction_index
+        self.menu_ids = {menu.message_id for menu in await RoleMenu.get_by()}
+        self.reaction_index_loaded = True
+        logger.debug(f"Indexed reaction roles on {len(self.reaction_index)} messages and {len(self.menu_ids)} role menus")
+
+    def index_reaction_role(self, entry):
+        """Adds a reaction role to the index, replacing any previous reaction for the same role on that message."""
+        reactions = self.reaction_index.setdefault(entry.message_id, {})
+        for reaction, role_id in list(reactions.items()):
+            if role_id == entry.role_id:
+                del reactions[reaction]
+        reactions[entry.reaction] = entry.role_id
+
+    def unindex_reaction_role(self, message_id: int, role_id: int):
+        """Removes a reaction role from the index."""
+        reactions = self.reaction_index.get(message_id, {})
+        for reaction, indexed_role_id in list(reactions.items()):
+            if indexed_role_id == role_id:
+                del reactions[reaction]
+        if not reactions:
+            self.reaction_index.pop(message_id, None)
+
+    def is_reaction_message(self, message_id: int):
+        """Whether a message may have reaction roles or be a role menu. Always true until the index has loaded."""
+        return not self.reaction_index_loaded or message_id in self.reaction_index or message_id in self.menu_ids
+
+    def schedule_removal(self, record):
+        """Schedules (or reschedules) the removal of a temporary role."""
+        key = (int(record.guild_id), int(record.target_id), int(record.target_role_id))
+        self.bot.timers.schedule("temprole", key, record.removal_ts, record)
 
     @Cog.listener()
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
         """Used to remove dead reaction role entries"""
         message_id = payload.message_id
+        if not self.is_reaction_message(message_id):
+            return
         await ReactionRole.delete(message_id = message_id)
         await RoleMenu.delete(message_id = message_id)
+        self.reaction_index.pop(message_id, None)
+        self.menu_ids.discard(message_id)
+
+    @Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        """Used to remove dead reaction role entries when messages are purged"""
+        message_ids = [message_id for message_id in payload.message_ids if self.is_reaction_message(message_id)]
+        if not message_ids:
+            return
+        await ReactionRole.delete_any("message_id", message_ids)
+        await RoleMenu.delete_any("message_id", message_ids)
+        for message_id in message_ids:
+            self.reaction_index.pop(message_id, None)
+            self.menu_ids.discard(message_id)
 
     @Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
@@ -94,13 +195,18 @@ class Roles(Cog):
     async def on_raw_reaction_action(self, payload: discord.RawReactionActionEvent):
         """Called whenever a reaction is added or removed"""
         message_id = payload.message_id
-        reaction = str(payload.emoji)
-        reaction_roles = await ReactionRole.get_by(message_id = message_id, reaction = reaction)
-        if len(reaction_roles):
+        if self.reaction_index_loaded:
+            if message_id not in self.reaction_index:
+                return
+            role_id = self.reaction_index[message_id].get(str(payload.emoji))
+        else:
+            reaction_roles = await ReactionRole.get_by(message_id = message_id, reaction = str(payload.emoji))
+            role_id = reaction_roles[0].role_id if reaction_roles else None
+        if role_id is not None:
             guild = self.bot.get_guild(payload.guild_id)
             member = guild.get_member(payload.user_id)
-            role = guild.get_role(reaction_roles[0].role_id)
-            if member.bot:
+            role = guild.get_role(role_id)
+            if member is None or member.bot:
                 return
             if role:
                 try:
@@ -111,22 +217,36 @@ class Roles(Cog):
                 except discord.Forbidden:
                     logger.debug(f"Unable to add reaction role in guild {guild} due to missing permissions")
 
-    async def removal_timer(self, record):
-        """Asynchronous task that sleeps for a set time to remove a role from a member after a set period of time."""
-
+    async def removal_timer(self, entry):
+        """Called by the timer scheduler to remove a role from a member once its time is up."""
+        record = entry.payload
         guild = self.bot.get_guild(int(record.guild_id))
-        target = guild.get_member(int(record.target_id))
-        target_role = guild.get_role(int(record.target_role_id))
-        removal_time = record.removal_ts
-
-        # Max function is used to make sure the delay is not negative
-        time_delta = max(int(removal_time - time.time()), 1)
-
-        await asyncio.sleep(time_delta)
-
-        await target.remove_roles(target_role)
-
-        await TempRoleTimerRecords.delete(id = record.id)
+        if guild is not None:
+            target = guild.get_member(int(record.target_id))
+            target_role = guild.get_role(int(record.target_role_id))
+            if target is not None and target_role is not None:
+                await target.remove_roles(target_role)
+
+        await TempRoleTimerRecords.delete(guild_id = record.guild_id, target_id = record.target_id,
+                                          target_role_id = record.target_role_id)
+
+    async def giveable_index(self, guild_id: int):
+        """Returns the giveable role index of a guild, loading it from the database on first use."""
+        index = self.giveable_indexes.get(guild_id)
+        if index is None:
+            index = GiveableRoleIndex(await GiveableRole.get_by(guild_id = guild_id))
+            index = self.giveable_indexes.setdefault(guild_id, index)
+        return index
+
+    async def giveable_role_autocomplete(self, interaction: discord.Interaction, current: str):
+        """Suggests giveable role names for the last comma-separated name being typed."""
+        if interaction.guild is None:
+            return []
+        index = await self.giveable_index(interaction.guild.id)
+        head, sep, last = current.rpartition(',')
+        typed = f"{head}{sep} " if sep else ""
+        return [app_commands.Choice(name = (typed + name)[:100], value = (typed + name)[:100])
+                for name in index.prefix_search(self.normalize(last))]
 
     @Cog.listener('on_guild_role_update')
     async def on_role_edit(self, old, new):
@@ -135,7 +255,9 @@ class Roles(Cog):
             results = await GiveableRole.get_by(norm_name = self.normalize(old.name), guild_id = old.guild.id)
             if results:
                 logger.debug(f"Role {new.id} name updated. updating name")
-                await GiveableRole.from_role(new).update_or_add()
+                record = GiveableRole.from_role(new)
+                await record.update_or_add()
+                (await self.giveable_index(new.guild.id)).add(record)
 
     @Cog.listener('on_guild_role_delete')
     async def on_role_delete(self, old):
@@ -144,19 +266,20 @@ class Roles(Cog):
         if results:
             logger.debug(f"Role {old.id} deleted. Deleting from database.")
             await GiveableRole.delete(role_id = old.id)
+            (await self.giveable_index(old.guild.id)).remove(old.id)
 
-    @Cog.listener('on_member_join')
-    async def on_member_join(self, member: discord.Member):
+    @Cog.listener('on_member_join_state')
+    async def on_member_join(self, member: discord.Member, state):
         """Restores a member's roles when they join if they have joined before."""
         me = member.guild.me
         top_restorable = me.top_role.position if me.guild_permissions.manage_roles else 0
-        restore = await MissingRole.get_by(guild_id = member.guild.id, member_id = member.id)
+        restore = state.get(MissingRole)
         if len(restore) == 0:
             return  # New member - nothing to restore
 
         # try and prioritize the member role first for Speed
         member_role_id = None
-        stg = await MemberRole.get_by(guild_id = member.guild.id)
+        stg = state.get(MemberRole)
         if stg:
             member_role_id = stg[0].member_role
             member_role = member.guild.get_role(member_role_id)
@@ -192,12 +315,12 @@ class Roles(Cog):
             e.add_field(name = 'I couldn\'t restore these roles, as I don\'t have permission.',
                         value = '\n'.join(sorted(cant_give)))
         try:
-            dest_id = await CustomJoinLeaveMessages.get_by(guild_id = member.guild.id)
-            dest = member.guild.get_channel(dest_id[0].memberlog_channel)
+            dest_id = state.get(CustomJoinLeaveMessages)
+            dest = member.guild.get_channel(dest_id[0].channel_id)
             await dest.send(embed = e)
         except discord.Forbidden:
             pass
-        except IndexError:
+        except (IndexError, AttributeError):
             pass
 
     @Cog.listener('on_member_remove')
@@ -208,29 +331,25 @@ class Roles(Cog):
         for role in member.roles[1:]:  # Exclude the @everyone role
             db_member = MissingRole(role_id = role.id, role_name = role.name, guild_id = guild_id,
                                     member_id = member_id)
-            await db_member.update_or_add()
+            await db_member.update_or_add_later()
 
     async def giveme_purge(self, rolelist):
         """Purges roles in the giveme database that no longer exist. The argument is a list of GiveableRole objects."""
+        if not rolelist:
+            return
+        await GiveableRole.delete_any("role_id", [role.role_id for role in rolelist])
         for role in rolelist:
-            dbrole = await GiveableRole.get_by(role_id = role.role_id)
-            if dbrole:
-                await GiveableRole.delete(role_id = role.role_id)
+            (await self.giveable_index(role.guild_id)).remove(role.role_id)
 
     async def ctx_purge(self, ctx: DozerContext):
         """Purges all giveme roles that no longer exist in a guild"""
-        counter = 0
-        roles = await GiveableRole.get_by(guild_id = ctx.guild.id)
-        guildroles = []
-        rolelist = []
-        for i in ctx.guild.roles:
-            guildroles.append(i.id)
-        for role in roles:
-            if role.role_id not in guildroles:
-                rolelist.append(role)
-                counter += 1
-        await self.giveme_purge(rolelist)
-        return counter
+        index = await self.giveable_index(ctx.guild.id)
+        stale = index.by_id.keys() - {role.id for role in ctx.guild.roles}
+        if stale:
+            await GiveableRole.delete_any("role_id", stale)
+            for role_id in stale:
+                index.remove(role_id)
+        return len(stale)
 
     async def on_guild_role_delete(self, role: discord.Role):
         """Automatically delete giveme roles if they are deleted from the guild"""
@@ -242,8 +361,7 @@ class Roles(Cog):
     async def giveme(self, ctx: DozerContext, *, roles):
         """Give you one or more giveable roles, separated by commas."""
         norm_names = [self.normalize(name) for name in roles.split(',')]
-        giveable_ids = [tup.role_id for tup in await GiveableRole.get_by(guild_id = ctx.guild.id) if
-                        tup.norm_name in norm_names]
+        giveable_ids = {tup.role_id for tup in (await self.giveable_index(ctx.guild.id)).find(norm_names)}
         valid = set(role for role in ctx.guild.roles if role.id in giveable_ids)
 
         already_have = valid & set(ctx.author.roles)
@@ -316,8 +434,8 @@ class Roles(Cog):
         if ',' in name:
             raise BadArgument('giveable role names must not contain commas!')
         norm_name = self.normalize(name)
-        settings = await GiveableRole.get_by(guild_id = ctx.guild.id, norm_name = norm_name)
-        if settings:
+        index = await self.giveable_index(ctx.guild.id)
+        if index.find([norm_name]):
             raise BadArgument('that role already exists and is giveable!')
         candidates = [role for role in ctx.guild.roles if self.normalize(role.name) == norm_name]
 
@@ -327,7 +445,9 @@ class Roles(Cog):
             role = candidates[0]
         else:
             raise BadArgument(f'{len(candidates)} roles with that name exist!')
-        await GiveableRole.from_role(role).update_or_add()
+        settings = GiveableRole.from_role(role)
+        await settings.update_or_add()
+        index.add(settings)
         await ctx.send(f'Role "{role.name}" added! Use `{ctx.prefix}{ctx.command.parent} {role.name}` to get it!')
 
     add.example_usage = """
@@ -344,11 +464,12 @@ class Roles(Cog):
         if ',' in name:
             raise BadArgument('giveable role names must not contain commas!')
         norm_name = self.normalize(name)
-        settings = await GiveableRole.get_by(guild_id = ctx.guild.id, norm_name = norm_name)
-        if not settings:
+        index = await self.giveable_index(ctx.guild.id)
+        if not index.find([norm_name]):
             role = await ctx.guild.create_role(name = name, reason = f'Giveable role created by {ctx.author}')
             settings = GiveableRole.from_role(role)
             await settings.update_or_add()
+            index.add(settings)
             await ctx.send(f'Role "{role.name}" created! Use `{ctx.prefix}{ctx.command.parent} {role.name}` to get it!')
 
         else:
@@ -364,12 +485,7 @@ class Roles(Cog):
     async def remove(self, ctx: DozerContext, *, roles):
         """Removes multiple giveable roles from you. Names must be separated by commas."""
         norm_names = [self.normalize(name) for name in roles.split(',')]
-        query = await GiveableRole.get_by(guild_id = ctx.guild.id)
-        roles_to_remove = []
-        for role in query:
-            if role.norm_name in norm_names:
-                roles_to_remove.append(role)
-        removable_ids = [tup.role_id for tup in roles_to_remove]
+        removable_ids = {tup.role_id for tup in (await self.giveable_index(ctx.guild.id)).find(norm_names)}
         valid = set(role for role in ctx.guild.roles if role.id in removable_ids)
 
         removed = valid & set(ctx.author.roles)
@@ -427,12 +543,9 @@ class Roles(Cog):
         if ',' in name:
             raise BadArgument('this command only works with single roles!')
         norm_name = self.normalize(name)
-        valid_ids = set(role.id for role in ctx.guild.roles)
-        roles = await GiveableRole.get_by(guild_id = ctx.guild.id, norm_name = norm_name)
-        valid_roles = []
-        for role_option in roles:
-            if role_option.role_id in valid_ids:
-                valid_roles.append(role_option)
+        index = await self.giveable_index(ctx.guild.id)
+        valid_roles = [role_option for role_option in index.find([norm_name])
+                       if ctx.guild.get_role(role_option.role_id) is not None]
         if len(valid_roles) == 0:
             raise BadArgument('that role does not exist or is not giveable!')
         elif len(valid_roles) > 1:
@@ -440,6 +553,7 @@ class Roles(Cog):
         else:
             role = ctx.guild.get_role(valid_roles[0].role_id)
             await GiveableRole.delete(guild_id = ctx.guild.id, norm_name = valid_roles[0].norm_name)
+            index.remove_name(valid_roles[0].norm_name)
             await role.delete(reason = f'Giveable role deleted by {ctx.author}')
             await ctx.send(f'Role "{role}" deleted!')
 
@@ -452,7 +566,7 @@ class Roles(Cog):
     @bot_has_permissions(manage_roles = True)
     async def list_roles(self, ctx: DozerContext):
         """Lists all giveable roles for this server."""
-        names = [tup.name for tup in await GiveableRole.get_by(guild_id = ctx.guild.id)]
+        names = [tup.name for tup in (await self.giveable_index(ctx.guild.id)).by_id.values()]
         e = discord.Embed(title = 'Roles available to self-assign', color = discord.Color.blue())
         e.description = '\n'.join(sorted(names, key = str.casefold))
         await ctx.send(embed = e)
@@ -475,21 +589,24 @@ class Roles(Cog):
         if ',' in name:
             raise BadArgument('this command only works with single roles!')
         norm_name = self.normalize(name)
-        valid_ids = set(role.id for role in ctx.guild.roles)
-        roles = await GiveableRole.get_by(guild_id = ctx.guild.id)
-        valid_roles = []
-        for role_option in roles:
-            if role_option.norm_name == norm_name and role_option.role_id in valid_ids:
-                valid_roles.append(role_option)
+        index = await self.giveable_index(ctx.guild.id)
+        valid_roles = [role_option for role_option in index.find([norm_name])
+                       if ctx.guild.get_role(role_option.role_id) is not None]
         if len(valid_roles) == 0:
             raise BadArgument('that role does not exist or is not giveable!')
         elif len(valid_roles) > 1:
             raise BadArgument('multiple giveable roles with that name exist!')
         else:
             await GiveableRole.delete(guild_id = ctx.guild.id, norm_name = valid_roles[0].norm_name)
+            index.remove_name(valid_roles[0].norm_name)
             await ctx.send(f'Role "{name}" deleted from list!')
 
-    delete.example_usage = """
+    role.autocomplete('roles')(giveable_role_autocomplete)
+    remove.autocomplete('roles')(giveable_role_autocomplete)
+    delete.autocomplete('name')(giveable_role_autocomplete)
+    removefromlist.autocomplete('name')(giveable_role_autocomplete)
+
+    removefromlist.example_usage = """
     `{prefix}giveme removefromlist Java` - removes the role "Java" from the list of giveable roles but does not remove it from the server or members who have it 
     """
 
@@ -517,7 +634,7 @@ class Roles(Cog):
 
         await member.add_roles(role)
         await ent.update_or_add()
-        self.bot.loop.create_task(self.removal_timer(ent))
+        self.schedule_removal(ent)
         e = discord.Embed(color = blurple)
         e.add_field(name = 'Success!', value = f'Gave {role.mention} to {member.mention} for {length}!')
         e.set_footer(text = 'Triggered by ' + escape_markdown(ctx.author.display_name))
@@ -638,6 +755,7 @@ class Roles(Cog):
             name = name
         )
         await e.update_or_add()
+        self.menu_ids.add(message.id)
 
         menu_embed.set_footer(text = f"Menu ID: {message.id}, Total roles: {0}")
         await message.edit(embed = menu_embed)
@@ -700,6 +818,7 @@ class Roles(Cog):
         if len(old_reaction):
             await self.del_from_message(message, old_reaction[0])
         await self.add_to_message(message, reaction_role)
+        self.index_reaction_role(reaction_role)
 
         if menu:
             await self.update_role_menu(ctx, menu)
@@ -735,6 +854,7 @@ class Roles(Cog):
         if len(reaction):
             await self.del_from_message(message, reaction[0])
             await ReactionRole.delete(message_id = message.id, role_id = role.id)
+            self.unindex_reaction_role(message.id, role.id)
         if menu:
             await self.update_role_menu(ctx, menu)
 
@@ -1,5 +1,4 @@
 from typing import Dict, List, Optional, Self
-# from fuzzywuzzy import process, fuzz
 
 import discord
 from discord import app_commands
@@ -13,14 +12,71 @@ from context import DozerContext
 from ._utils import *
 
 
+class ShortcutTable:
+    """
+    In-memory shortcuts of one guild: the prefix, a name -> value map for exact lookups and a trie of casefolded names
+    for fuzzy (case-insensitive, longest prefix) matching.
+    """
+
+    def __init__(self, prefix: Optional[str], entries = ()):
+        self.prefix = prefix
+        self.entries: Dict[str, str] = {}
+        self.trie = {}
+        for entry in entries:
+            self.add(entry.name, entry.value)
+
+    def add(self, name: str, value: str):
+        """Adds or updates a shortcut."""
+        self.entries[name] = value
+        node = self.trie
+        for char in name.casefold():
+            node = node.setdefault(char, {})
+        node[None] = name  # None marks the end of a name, and is never a character
+
+    def remove(self, name: str):
+        """Removes a shortcut, rebuilding the trie (removals are rare compared to lookups)."""
+        del self.entries[name]
+        self.trie = {}
+        for entry_name, value in list(self.entries.items()):
+            self.add(entry_name, value)
+
+    def match(self, text: str) -> Optional[str]:
+        """
+        Returns the shortcut name invoked by `text` (the message content right after the prefix), if any.
+        An exact match on the first word wins; otherwise the longest name that `text` starts with, ignoring case, as long
+        as it isn't followed directly by more letters or digits.
+        """
+        words = text.split()
+        if words and words[0] in self.entries:
+            return words[0]
+        folded = text.casefold()
+        node = self.trie
+        best = None
+        for i, char in enumerate(folded):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node and (i + 1 == len(folded) or not folded[i + 1].isalnum()):
+                best = node[None]
+        return best
+
+
 class Shortcuts(Cog):
     """Adds simple text-shortcuts to the bot"""
     MAX_LEN = 20
     def __init__(self, bot):
         """cog init"""
         super().__init__(bot)
-        self.settings_cache = db.ConfigCache(ShortcutSetting)
-        self.cache = db.ConfigCache(ShortcutEntry)
+        self.tables: Dict[int, ShortcutTable] = {}
+
+    async def get_table(self, guild_id: int) -> ShortcutTable:
+        """Returns the in-memory shortcut table of a guild, loading it from the database on first use."""
+        table = self.tables.get(guild_id)
+        if table is None:
+            setting = await ShortcutSetting.get_unique_by(guild_id = guild_id)
+            entries = await ShortcutEntry.get_by(guild_id = guild_id) if setting else []
+            table = self.tables.setdefault(guild_id, ShortcutTable(setting.prefix if setting else None, entries))
+        return table
 
     """Commands for managing shortcuts/macros."""
 
@@ -30,14 +86,14 @@ class Shortcuts(Cog):
         """
         Display shortcut information
         """
-        settings: ShortcutSetting = await self.settings_cache.query_one(guild_id=ctx.guild.id)
+        table = await self.get_table(ctx.guild.id)
 
-        if settings is None:
+        if table.prefix is None:
             raise BadArgument("This server has no shortcut configuration, set a prefix.")
 
         e = discord.Embed()
         e.title = "Server shortcut configuration"
-        e.add_field(name="Shortcut prefix", value=settings.prefix or "[unset]")
+        e.add_field(name="Shortcut prefix", value=table.prefix or "[unset]")
         await ctx.send(embed=e)
 
     @has_permissions(manage_messages=True)
@@ -45,15 +101,16 @@ class Shortcuts(Cog):
     @app_commands.describe(prefix = "Prefix you want to use (such as ! or &)")
     async def setprefix(self, ctx, prefix):
         """Set the prefix to be used to respond to shortcuts for the server."""
-        setting: ShortcutSetting = await self.settings_cache.query_one(guild_id=ctx.guild.id)
-
-        if setting:
-            setting.prefix = prefix
-        else:
-            setting = ShortcutSetting(guild_id=ctx.guild.id, prefix=prefix)
+        table = await self.get_table(ctx.guild.id)
+        setting = ShortcutSetting(guild_id=ctx.guild.id, prefix=prefix)
 
         await setting.update_or_add()
-        self.settings_cache.invalidate_entry(guild_id=ctx.guild.id)
+        if table.prefix is None:
+            # the table was never populated for a guild without a prefix, so load it fresh
+            self.tables.pop(ctx.guild.id, None)
+            await self.get_table(ctx.guild.id)
+        else:
+            table.prefix = prefix
 
         await ctx.send(f"Set prefix to: {prefix}")
 
@@ -62,23 +119,18 @@ class Shortcuts(Cog):
     @app_commands.describe(cmd_name = "shortcut name", cmd_msg = "stuff shortcut should display")
     async def add(self, ctx: DozerContext, cmd_name, *, cmd_msg):
         """Set the message to be sent for a given shortcut name."""
-        settings: ShortcutSetting = await self.settings_cache.query_one(guild_id=ctx.guild.id)
-        if settings is None:
+        table = await self.get_table(ctx.guild.id)
+        if table.prefix is None:
             raise BadArgument("Set a prefix first!")
         if len(cmd_name) > self.MAX_LEN:
             raise BadArgument(f"command names can only be up to {self.MAX_LEN} chars long")
         if not cmd_msg:
             raise BadArgument("can't have null message")
 
-        ent: ShortcutEntry = await self.cache.query_one(guild_id=ctx.guild.id, name=cmd_name)
-
-        if ent:
-            ent.value = cmd_msg
-        else:
-            ent = ShortcutEntry(guild_id=ctx.guild.id, name=cmd_name, value=cmd_msg)
+        ent = ShortcutEntry(guild_id=ctx.guild.id, name=cmd_name, value=cmd_msg)
 
         await ent.update_or_add()
-        self.cache.invalidate_entry(guild_id=ctx.guild.id, name=cmd_name)
+        table.add(cmd_name, cmd_msg)
 
         await ctx.send("Updated command successfully.")
 
@@ -87,11 +139,11 @@ class Shortcuts(Cog):
     @app_commands.describe(cmd_name = "shortcut name")
     async def remove(self, ctx: DozerContext, cmd_name):
         """Removes a shortcut from the server by name."""
-        ent: ShortcutEntry = await self.cache.query_one(guild_id=ctx.guild.id, name=cmd_name)
+        table = await self.get_table(ctx.guild.id)
 
-        if ent:
+        if cmd_name in table.entries:
             await ShortcutEntry.delete(guild_id=ctx.guild.id, name=cmd_name)
-            self.cache.invalidate_entry(guild_id=ctx.guild.id, name=cmd_name)
+            table.remove(cmd_name)
             await ctx.send(f"Removed command {cmd_name} successfully.")
         else:
             await ctx.send(f"No command named {cmd_name} found!", ephemeral = True)
@@ -99,22 +151,20 @@ class Shortcuts(Cog):
     @shortcuts.command()
     async def list(self, ctx: DozerContext):
         """List all shortcuts for this server."""
-        settings: ShortcutSetting = await self.settings_cache.query_one(guild_id=ctx.guild.id)
+        table = await self.get_table(ctx.guild.id)
 
-        ents: List[ShortcutEntry] = await ShortcutEntry.get_by(guild_id=ctx.guild.id)
-
-        if not ents:
+        if not table.entries:
             await ctx.send("No shortcuts for this server!")
             return
 
         embed = None
-        for i, e in enumerate(ents):
+        for i, (name, value) in enumerate(table.entries.items()):
             if i % 20 == 0:
                 if embed is not None:
                     await ctx.send(embed=embed)
                 embed = discord.Embed()
                 embed.title = "Shortcuts for this server"
-            embed.add_field(name=settings.prefix + e.name, value=e.value[:1024])
+            embed.add_field(name=table.prefix + name, value=value[:1024])
 
         if embed.fields:
             await ctx.send(embed=embed, ephemeral = True)
@@ -130,15 +180,12 @@ class Shortcuts(Cog):
         if not msg.guild or msg.author.bot:
             return
 
-        setting = await ShortcutSetting.get_unique_by(guild_id = msg.guild.id)
-        if not setting:
+        table = await self.get_table(msg.guild.id)
+        if table.prefix is None or not table.entries:
             return
 
-        # Search for the prefix within the message content
-        prefix = setting.prefix
-        prefix_index = msg.content.find(prefix)
-
         # Check for the presence of the prefix anywhere in the message
+        prefix = table.prefix
         prefix_index = msg.content.find(prefix)
 
         if prefix_index != -1:
@@ -146,49 +193,22 @@ class Shortcuts(Cog):
             if prefix_index + len(prefix) < len(msg.content) and msg.content[prefix_index + len(prefix)] == ' ':
                 return  # there's a space, so it was probably meant to be used in text rather than call a shortcut
 
-            # Extract the command part from the message directly after the prefix
-            start_index = prefix_index + len(prefix)
-            remaining_content = msg.content[start_index:].strip()
-
-            # Extract the command name before any spaces or punctuation
-            command_name = remaining_content.split()[0] if remaining_content.split() else ""
+            # Match the content directly after the prefix against the guild's shortcuts
+            remaining_content = msg.content[prefix_index + len(prefix):].strip()
+            shortcut_name = table.match(remaining_content)
 
-            # Check if the extracted command name matches any valid shortcuts
-            all_shortcuts = await ShortcutEntry.get_by(guild_id = msg.guild.id)
-            all_shortcuts = [s.name for s in all_shortcuts]
-
-            if command_name in all_shortcuts:
-                shortcut = await ShortcutEntry.get_unique_by(guild_id = msg.guild.id, name = command_name)
+            if shortcut_name is not None:
+                value = table.entries[shortcut_name]
                 if msg.reference:
                     # Fetch the original message being replied to
-                    original_message = await msg.channel.fetch_message(msg.reference.message_id)
-                    if original_message:
-                        # Ping the original author in the new message
-                        await original_message.reply(f"{shortcut.value}")
+                    original_message = msg.reference.resolved
+                    if not isinstance(original_message, discord.Message):
+                        original_message = await msg.channel.fetch_message(msg.reference.message_id)
+                    # Ping the original author in the new message
+                    await original_message.reply(f"{value}")
                 else:
                     # Send the shortcut value without pinging if original message is not found
-                    await msg.channel.send(shortcut.value)
-
-            # best_match = process.extractOne(remaining_content, all_shortcuts, scorer = fuzz.partial_ratio)
-            #
-            # if best_match and best_match[1] > 90:  # Adjust the threshold as needed
-            #     shortcut_name = best_match[0]
-            #
-            #     # Ensure the command follows immediately after the prefix without any intervening characters
-            #     if remaining_content.startswith(shortcut_name.casefold()):
-            #         shortcut = await ShortcutEntry.get_unique_by(guild_id = msg.guild.id, name = shortcut_name)
-            #         if msg.reference:
-            #             # Fetch the original message being replied to
-            #             original_message = await msg.channel.fetch_message(msg.reference.message_id)
-            #             if original_message:
-            #                 # Ping the original author in the new message
-            #                 await original_message.reply(f"{shortcut.value}")
-            #         else:
-            #             # Send the shortcut value without pinging if original message is not found
-            #             await msg.channel.send(shortcut.value)
-        else:
-            # If the prefix is not found in the message, do nothing
-            pass
+                    await msg.channel.send(value)
 
 
 """Database Tables"""
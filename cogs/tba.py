@@ -9,12 +9,9 @@ from urllib.parse import quote as urlquote, urljoin
 import aiohttp
 import discord
 from discord.ext.commands import BadArgument
-import googlemaps
 import async_timeout
 import aiotba
 import pendulum
-from geopy.geocoders import Nominatim
-from timezonefinder import TimezoneFinder
 from discord.ext import commands
 
 from cogs._utils import *
@@ -30,7 +27,6 @@ class TBA(Cog):
         #self.gmaps_key = bot.config['gmaps_key']
         self.http_session = bot.add_aiohttp_ses(aiohttp.ClientSession(timeout = aiohttp.ClientTimeout(5)))
         self.session = aiotba.TBASession(tba_config['key'], self.bot.http_session)
-        self.tzf = TimezoneFinder()
         self.bot = bot
 
         # self.parser = tbapi.TBAParser(tba_config['key'], cache=False)
@@ -282,7 +278,8 @@ class TBA(Cog):
     """
 
 
-# timezone is disabled due to its use of gmaps
+# timezone is disabled due to its use of gmaps; re-enabling it means importing googlemaps, geopy and timezonefinder
+# (and building self.tzf) again, which the cog no longer does on load
 '''
     @command()
     async def timezone(self, ctx, team_program: str, team_num: int):
@@ -1,4 +1,7 @@
 """Commands for making and seeing robotics team associations."""
+import asyncio
+import heapq
+from collections import Counter
 
 from discord import app_commands
 from discord.ext import commands
@@ -13,12 +16,137 @@ from ._utils import *
 
 
 # alter table team_numbers alter column team_number type text
+class TeamIndex:
+    """
+    In-memory index of team associations, kept in sync with the team_numbers table.
+    Team counts per guild are built from the index on first use and then maintained incrementally as associations
+    change and members join or leave, so leaderboards never have to aggregate over the whole guild again.
+    """
+
+    def __init__(self, records = ()):
+        self.user_teams = {}  # user_id: {(team_type, team_number)}
+        self.team_users = {}  # (team_type, team_number): {user_id}
+        self.guild_counts = {}  # guild_id: Counter of (team_type, team_number) over the guild's current members
+        for record in records:
+            self._link(record.user_id, self.key(record.team_type, record.team_number))
+
+    @staticmethod
+    def key(team_type, team_number):
+        """Normalizes a team into the tuple used as index key. team_number is stored as text in the database."""
+        return team_type.casefold(), str(team_number)
+
+    def _link(self, user_id, team):
+        self.user_teams.setdefault(user_id, set()).add(team)
+        self.team_users.setdefault(team, set()).add(user_id)
+
+    def _adjust(self, guilds, user_id, teams, delta):
+        """Applies a count change for `user_id`'s `teams` to every already-built guild counter they are a member of."""
+        for guild in guilds:
+            counts = self.guild_counts.get(guild.id)
+            if counts is None or guild.get_member(user_id) is None:
+                continue
+            for team in teams:
+                counts[team] += delta
+                if counts[team] <= 0:
+                    del counts[team]
+
+    def add(self, user_id, team_type, team_number, guilds):
+        """Records a new association and updates the counts of the given guilds."""
+        team = self.key(team_type, team_number)
+        if team in self.user_teams.get(user_id, ()):
+            return
+        self._link(user_id, team)
+        self._adjust(guilds, user_id, (team,), 1)
+
+    def remove(self, user_id, team_type, team_number, guilds):
+        """Removes an association and updates the counts of the given guilds."""
+        team = self.key(team_type, team_number)
+        if team not in self.user_teams.get(user_id, ()):
+            return
+        self._adjust(guilds, user_id, (team,), -1)
+        self.user_teams[user_id].discard(team)
+        if not self.user_teams[user_id]:
+            del self.user_teams[user_id]
+        self.team_users[team].discard(user_id)
+        if not self.team_users[team]:
+            del self.team_users[team]
+
+    def member_join(self, member):
+        """Counts a joining member's teams in their guild."""
+        counts = self.guild_counts.get(member.guild.id)
+        if counts is not None:
+            counts.update(self.user_teams.get(member.id, ()))
+
+    def member_remove(self, member):
+        """Stops counting a leaving member's teams in their guild."""
+        counts = self.guild_counts.get(member.guild.id)
+        if counts is not None:
+            counts.subtract(self.user_teams.get(member.id, ()))
+            for team in [team for team, count in counts.items() if count <= 0]:
+                del counts[team]
+
+    def counts_for(self, guild):
+        """Returns the team counts of a guild, building them on first use."""
+        counts = self.guild_counts.get(guild.id)
+        if counts is None:
+            counts = Counter()
+            if len(self.user_teams) < guild.member_count:
+                for user_id, teams in self.user_teams.items():
+                    if guild.get_member(user_id) is not None:
+                        counts.update(teams)
+            else:
+                for member in guild.members:
+                    counts.update(self.user_teams.get(member.id, ()))
+            self.guild_counts[guild.id] = counts
+        return counts
+
+    def top(self, guild, n: int = 10):
+        """Returns the n teams with the most members in a guild as (team_type, team_number, count) tuples."""
+        counts = self.counts_for(guild)
+        best = heapq.nsmallest(n, counts.items(), key = lambda item: (-item[1], item[0][0], item[0][1]))
+        return [(team_type, team_number, count) for (team_type, team_number), count in best]
+
+
 class Teams(Cog):
     """Commands for making and seeing robotics team associations."""
 
     def __init__(self, bot: commands.Bot) -> None:
         super().__init__(bot)
         self.bot = bot
+        self.team_index = None
+        self._index_lock = asyncio.Lock()
+
+    async def get_index(self) -> TeamIndex:
+        """Returns the team index, loading every association from the database on first use."""
+        if self.team_index is None:
+            async with self._index_lock:
+                if self.team_index is None:
+                    self.team_index = TeamIndex(await TeamNumbers.get_by())
+        return self.team_index
+
+    @Cog.listener('on_ready')
+    async def on_ready(self):
+        """Drop per-guild team counts, since member joins and leaves may have been missed while disconnected"""
+        if self.team_index is not None:
+            self.team_index.guild_counts.clear()
+
+    @Cog.listener('on_member_join')
+    async def on_member_join(self, member: discord.Member):
+        """Counts a joining member's teams."""
+        if self.team_index is not None:
+            self.team_index.member_join(member)
+
+    @Cog.listener('on_member_remove')
+    async def on_member_remove(self, member: discord.Member):
+        """Stops counting a leaving member's teams."""
+        if self.team_index is not None:
+            self.team_index.member_remove(member)
+
+    @Cog.listener('on_guild_remove')
+    async def on_guild_remove(self, guild: discord.Guild):
+        """Forgets the team counts of a guild the bot left."""
+        if self.team_index is not None:
+            self.team_index.guild_counts.pop(guild.id, None)
 
     @classmethod
     def validate(cls, team_type, team_number):
@@ -51,9 +179,10 @@ class Teams(Cog):
     async def setteam(self, ctx: DozerContext, team_type: str, team_number: int):
         """Sets an association with your team in the database."""
         team_type = team_type.casefold()
-        dbcheck = await TeamNumbers.get_by(user_id=ctx.author.id, team_type=team_type, team_number=team_number)
-        if not dbcheck:
+        index = await self.get_index()
+        if TeamIndex.key(team_type, team_number) not in index.user_teams.get(ctx.author.id, ()):
             await TeamNumbers(user_id=ctx.author.id, team_number=team_number, team_type=team_type).update_or_add()
+            index.add(ctx.author.id, team_type, team_number, ctx.author.mutual_guilds)
             await ctx.send("Team number set!")
         else:
             raise BadArgument("You are already associated with that team!")
@@ -68,9 +197,10 @@ class Teams(Cog):
     async def removeteam(self, ctx: DozerContext, team_type: str, team_number: int):
         """Removes an association with a team in the database."""
         team_type = team_type.casefold()
-        results = await TeamNumbers.get_by(user_id=ctx.author.id, team_type=team_type, team_number=team_number)
-        if len(results) != 0:
+        index = await self.get_index()
+        if TeamIndex.key(team_type, team_number) in index.user_teams.get(ctx.author.id, ()):
             await TeamNumbers.delete(user_id=ctx.author.id, team_number=team_number, team_type=team_type)
+            index.remove(ctx.author.id, team_type, team_number, ctx.author.mutual_guilds)
             await ctx.send(f"Removed association with {team_type} team {team_number}")
         else:
             await ctx.send("Couldn't find any associations with that team!")
@@ -87,15 +217,15 @@ class Teams(Cog):
         if user is None:
             user = ctx.author
 
-        teams = await TeamNumbers.get_by(user_id = user.id)
+        teams = (await self.get_index()).user_teams.get(user.id)
         if not teams:
             raise BadArgument("Couldn't find any team associations for that user!")
         else:
             e = discord.Embed(type = 'rich')
             e.title = 'Teams for {}'.format(user.display_name)
             e.description = "Teams: \n"
-            for i in teams:
-                e.description = f"{e.description} {i.team_type.upper()} Team {i.team_number} \n"
+            for team_type, team_number in sorted(teams):
+                e.description = f"{e.description} {team_type.upper()} Team {team_number} \n"
             if len(e.description) > 4000:
                 e.description = e.description[:4000] + "..."
             await ctx.send(embed = e)
@@ -109,8 +239,8 @@ class Teams(Cog):
     @app_commands.describe(team_type = "ftc, frc, or fll", team_number = "Team number")
     async def onteam(self, ctx: DozerContext, team_type: str, team_number: int):
         """Allows you to see who has associated themselves with a particular team."""
-        team_type = team_type.casefold()
-        users = await TeamNumbers.get_by(team_type=team_type, team_number=team_number)
+        user_ids = (await self.get_index()).team_users.get(TeamIndex.key(team_type, team_number), ())
+        users = [member for member in map(ctx.guild.get_member, user_ids) if member is not None]
         if len(users) == 0:
             await ctx.send("Nobody on that team found!")
         else:
@@ -118,14 +248,12 @@ class Teams(Cog):
             e.title = f'Users on team {team_number}'
             e.description = "Users: \n"
             extra_mems = ""
-            for i in users:
-                user = ctx.guild.get_member(i.user_id)
-                if user is not None:
-                    memstr = f"{escape_markdown(user.display_name)} {user.mention} \n"
-                    if len(e.description + memstr) > 2047:
-                        extra_mems += memstr
-                    else:
-                        e.description = e.description + memstr
+            for user in users:
+                memstr = f"{escape_markdown(user.display_name)} {user.mention} \n"
+                if len(e.description + memstr) > 2047:
+                    extra_mems += memstr
+                else:
+                    e.description = e.description + memstr
             if len(extra_mems) != 0:
                 e.add_field(name=f"Users on team {team_number}", value=extra_mems)
             await ctx.send(embed=e)
@@ -138,8 +266,7 @@ class Teams(Cog):
     @guild_only()
     async def top(self, ctx):
         """Show the top 10 teams by number of members in this guild."""
-        users = [mem.id for mem in ctx.guild.members]
-        counts = await TeamNumbers.top10(users)
+        counts = (await self.get_index()).top(ctx.guild)
         embed = discord.Embed(title = f'Top teams in {ctx.guild.name}', color = discord.Color.blue())
         embed.description = '\n'.join(
             f'{type_.upper()} team {num} ({count} member{"s" if count > 1 else ""})' for (type_, num, count) in counts)
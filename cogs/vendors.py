@@ -3,7 +3,6 @@
 import discord
 import aiohttp
 import async_timeout
-from bs4 import BeautifulSoup
 from discord.ext import commands
 
 
@@ -17,6 +16,7 @@ class VendorSearcher:
         self.bot = bot
 
     async def get_soup(self, url):
+        from bs4 import BeautifulSoup
         async with self.http.get(url) as response, async_timeout.timeout(5) as _:
             return BeautifulSoup(response.text(), 'html.parser')
 
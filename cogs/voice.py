@@ -2,6 +2,7 @@
 
 import discord
 from discord.ext.commands import has_permissions
+from loguru import logger
 from discord import app_commands
 from discord.ext import commands
 import db
@@ -10,27 +11,67 @@ from ._utils import *
 from tools import Confirm
 
 
-class Voice(commands.Cog):
+class Voice(Cog):
     """Commands interacting with voice."""
 
+    role_debounce = 1.0  # seconds to wait for a member to settle in a channel before updating their roles
+
+    def __init__(self, bot):
+        super().__init__(bot)
+        self.binds = None  # channel_id: role_id, loaded on first use
+        self.pending_roles = {}  # (guild_id, member_id): [role ids to remove, role id to add, timer handle]
+
+    async def load_binds(self):
+        """Loads every voicebind into memory."""
+        binds = {}
+        for config in await Voicebinds.get_by():
+            binds.setdefault(config.channel_id, config.role_id)
+        self.binds = binds
+
     @Cog.listener('on_voice_state_update')
     async def on_voice_state_update(self, member, before, after):
         """Handles voicebinds when members join/leave voice channels"""
         # skip this if we have no perms, or if it's something like a mute/deafen
         if member.guild.me.guild_permissions.manage_roles and before.channel != after.channel:
-            # determine if it's a join/leave event as well.
-            # before and after are voice states
-            if before.channel is not None:
-                # leave event, take role
-                config = await Voicebinds.get_by(channel_id=before.channel.id)
-                if config is not None:
-                    await member.remove_roles(member.guild.get_role(config[0].role_id))
+            if self.binds is None:
+                await self.load_binds()
+            before_role = self.binds.get(before.channel.id) if before.channel is not None else None
+            after_role = self.binds.get(after.channel.id) if after.channel is not None else None
+            if before_role is None and after_role is None:
+                return
 
-            if after.channel is not None:
-                # join event, give role
-                config = await Voicebinds.get_by(channel_id=after.channel.id)
-                if config is not None:
-                    await member.add_roles(member.guild.get_role(config[0].role_id))
+            # coalesce rapid channel hopping into a single role update once the member settles
+            key = (member.guild.id, member.id)
+            pending = self.pending_roles.get(key)
+            if pending is None:
+                pending = self.pending_roles[key] = [set(), None, None]
+            else:
+                pending[2].cancel()
+            if before_role is not None:
+                # leave event, take role
+                pending[0].add(before_role)
+            # join event, give role
+            pending[1] = after_role
+            pending[0].discard(after_role)
+            pending[2] = self.bot.loop.call_later(self.role_debounce, lambda: self.bot.loop.create_task(
+                self.apply_voice_roles(member.guild, member.id)))
+
+    async def apply_voice_roles(self, guild: discord.Guild, member_id: int):
+        """Applies the net voicebind role changes queued up for a member in one edit."""
+        remove, add, _ = self.pending_roles.pop((guild.id, member_id), (set(), None, None))
+        member = guild.get_member(member_id)
+        if member is None:
+            return
+        roles = [role for role in member.roles[1:] if role.id not in remove]
+        if add is not None and member.get_role(add) is None:
+            role = guild.get_role(add)
+            if role is not None:
+                roles.append(role)
+        if set(roles) != set(member.roles[1:]):
+            try:
+                await member.edit(roles=roles, reason="Voicebind")
+            except discord.HTTPException as e:
+                logger.warning(f"Failed to update voicebind roles of {member} in {guild}: {e}")
 
     @command()
     @bot_has_permissions(manage_roles=True)
@@ -54,6 +95,8 @@ class Voice(commands.Cog):
             await config[0].update_or_add()
         else:
             await Voicebinds(channel_id=voice_channel.id, role_id=role.id, guild_id=ctx.guild.id).update_or_add()
+        if self.binds is not None:
+            self.binds[voice_channel.id] = role.id
 
         await ctx.send(f"Role `{role}` will now be given to users in voice channel `{voice_channel}`!", ephemeral=True)
 
@@ -69,21 +112,16 @@ class Voice(commands.Cog):
     async def voiceunbind(self, ctx: DozerContext, voice_channel: discord.VoiceChannel):
         """Dissociates a voice channel with a role previously bound with the voicebind command."""
         config = await Voicebinds.get_by(channel_id=voice_channel.id)
-        if config is not None:
-            try:
-                role = discord.utils.get(ctx.guild.roles, id=config[0].role_id)
-            except Exception as e:
-                await ctx.send(f"`{voice_channel}` is already not associated with any roles.", ephemeral=True)
-                return
-            if not config:
-                await ctx.send(f"It appears that `{voice_channel}` is not associated with a role!", ephemeral=True)
-            else:
-                await Voicebinds.delete(id=config[0].id)
-                await ctx.send(
-                    f"Role `{role.name}` will no longer be given to users in voice channel `{voice_channel}`!",
-                    ephemeral=True)
-        else:
+        if not config:
             await ctx.send(f"It appears that `{voice_channel}` is not associated with a role!", ephemeral=True)
+            return
+        await Voicebinds.delete(id=config[0].id)
+        if self.binds is not None:
+            self.binds.pop(voice_channel.id, None)
+        role = ctx.guild.get_role(config[0].role_id)
+        role_name = role.name if role is not None else config[0].role_id
+        await ctx.send(f"Role `{role_name}` will no longer be given to users in voice channel `{voice_channel}`!",
+                       ephemeral=True)
 
     voiceunbind.example_usage = """
     `{prefix}voiceunbind "General #1"` - Removes automatic role-giving for users in "General #1".
@@ -1,49 +1,295 @@
 """Provides database storage for the Dozer Discord bot"""
-from typing import List, Dict, Tuple, Callable, Coroutine
+import asyncio
+import heapq
+import itertools
+import sys
+import time
+from collections import deque
+from typing import List, Dict, Set, Tuple, Callable, Coroutine
 
 import asyncpg
 from loguru import logger
 
+import metrics
+
 Pool = None
 
 
 async def db_init(db_url):
     """Initializes the database connection"""
     global Pool
-    Pool = await asyncpg.create_pool(statement_cache_size=0, dsn=db_url, command_timeout=15)
+    Pool = TracingPool(await asyncpg.create_pool(statement_cache_size=0, dsn=db_url, command_timeout=15))
+
+
+class QueryTrace:
+    """Timing of one executed statement"""
+    __slots__ = ('query', 'elapsed', 'wait', 'rows', 'cog', 'when')
+
+    def __init__(self, query: str, elapsed: float, wait: float, rows, cog):
+        self.query = query
+        self.elapsed = elapsed
+        self.wait = wait
+        self.rows = rows
+        self.cog = cog
+        self.when = time.time()
+
+
+class QueryTracer:
+    """Keeps the `keep` slowest statements seen, and a log of the most recent statements slower than
+    `slow_threshold` seconds."""
+
+    def __init__(self, slow_threshold: float = 0.1, keep: int = 50, log_size: int = 200):
+        self.slow_threshold = slow_threshold
+        self.keep = keep
+        self.slowest: List[Tuple[float, int, QueryTrace]] = []  # min-heap, so the fastest kept statement is evicted
+        self.slow_log = deque(maxlen=log_size)
+        self._counter = itertools.count()
+
+    def record(self, trace: QueryTrace):
+        """Records an executed statement"""
+        metrics.record_db(trace.elapsed, trace.cog or "other")
+        entry = (trace.elapsed, next(self._counter), trace)
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, entry)
+        elif trace.elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+        if trace.elapsed >= self.slow_threshold:
+            self.slow_log.append(trace)
+            logger.debug(f"Slow query ({trace.elapsed * 1000:.0f}ms, {trace.rows} rows, from {trace.cog}): "
+                         f"{' '.join(trace.query.split())[:200]}")
+
+    def top(self, n: int = 10) -> List[QueryTrace]:
+        """Returns the n slowest statements, slowest first"""
+        return [trace for _, _, trace in heapq.nlargest(n, self.slowest)]
+
+    def reset(self):
+        """Forgets every recorded statement"""
+        self.slowest.clear()
+        self.slow_log.clear()
+
+
+Tracer = QueryTracer()
+
+
+def _calling_cog():
+    """Returns the name of the cog or component module that issued the current query, if there is one."""
+    frame = sys._getframe(2)
+    for _ in range(20):
+        if frame is None:
+            break
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith(('cogs.', 'Components.')):
+            return module.rsplit('.', 1)[-1]
+        frame = frame.f_back
+    return None
+
+
+class TracedConnection:
+    """Wraps a pool connection to time each statement it runs. Anything not traced is passed to the connection."""
+
+    def __init__(self, conn, wait: float = 0.0):
+        self._conn = conn
+        self._wait = wait  # pool wait, charged to the first statement
+
+    async def _traced(self, method, query, args, kwargs):
+        cog = _calling_cog()
+        start = time.perf_counter()
+        result = None
+        try:
+            result = await getattr(self._conn, method)(query, *args, **kwargs)
+            return result
+        finally:
+            if method == 'executemany':
+                rows = len(args[0]) if args else 0
+            elif method == 'fetch':
+                rows = len(result) if result is not None else None
+            elif method == 'execute':
+                # status strings end in the affected row count, e.g. "DELETE 3"
+                count = result.rsplit(' ', 1)[-1] if isinstance(result, str) else ''
+                rows = int(count) if count.isdigit() else None
+            else:
+                rows = int(result is not None)
+            Tracer.record(QueryTrace(query, time.perf_counter() - start, self._wait, rows, cog))
+            self._wait = 0.0
+
+    async def execute(self, query, *args, **kwargs):
+        """Traced Connection.execute"""
+        return await self._traced('execute', query, args, kwargs)
+
+    async def executemany(self, query, *args, **kwargs):
+        """Traced Connection.executemany"""
+        return await self._traced('executemany', query, args, kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        """Traced Connection.fetch"""
+        return await self._traced('fetch', query, args, kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        """Traced Connection.fetchrow"""
+        return await self._traced('fetchrow', query, args, kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        """Traced Connection.fetchval"""
+        return await self._traced('fetchval', query, args, kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self._conn, item)
+
+
+class _TracedAcquire:
+    """Acquires a pool connection, timing the wait"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        self.conn = await self.pool.acquire()
+        wait = time.perf_counter() - start
+        metrics.registry.observe("db_pool_wait", "pool", wait)
+        return TracedConnection(self.conn, wait)
+
+    async def __aexit__(self, *exc):
+        await self.pool.release(self.conn)
+        return False
+
+
+class TracingPool:
+    """Wraps the asyncpg pool so every connection it hands out traces its statements."""
+
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+
+    def acquire(self):
+        """Returns a context manager yielding a traced connection"""
+        return _TracedAcquire(self._pool)
+
+    async def execute(self, query, *args, **kwargs):
+        """Runs one statement on a pool connection"""
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, **kwargs)
+
+    async def executemany(self, query, *args, **kwargs):
+        """Runs one statement many times on a pool connection"""
+        async with self.acquire() as conn:
+            return await conn.executemany(query, *args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        """Fetches rows on a pool connection"""
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        """Fetches a row on a pool connection"""
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        """Fetches a value on a pool connection"""
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, **kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self._pool, item)
+
+
+class _MigrationPool:
+    """Stands in for the pool while migrations run, so every table's migration functions use the migration
+    connection and its transaction."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire(self):
+        """Returns a context manager yielding the migration connection"""
+        conn = self.conn
+
+        class _Acquire:
+            async def __aenter__(self):
+                return conn
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Acquire()
+
+    def __getattr__(self, item):
+        return getattr(self.conn, item)
+
+
+def _table_classes():
+    """Walks every DatabaseTable subclass, including subclasses of subclasses."""
+    seen = {}
+    stack = list(DatabaseTable.__subclasses__())
+    while stack:
+        cls = stack.pop()
+        stack.extend(cls.__subclasses__())
+        if not cls.__tablename__:
+            continue
+        # a few tables are declared by more than one module; migrate with the most up to date declaration
+        other = seen.get(cls.__tablename__)
+        if other is None or len(cls.__versions__) > len(other.__versions__):
+            seen[cls.__tablename__] = cls
+    return list(seen.values())
+
+
+async def _migration_plan(conn, tables):
+    """Finds which tables need creating, registering and migrating, using one query for the existing tables and one
+    for their versions."""
+    existing = {row['table_name'] for row in await conn.fetch("SELECT table_name FROM information_schema.tables")}
+    versions = {}
+    if 'versions' in existing:
+        versions = {row['table_name']: row['version_num'] for row in
+                    await conn.fetch("SELECT table_name, version_num FROM versions")}
+    plan = []
+    for cls in tables:
+        create = cls.__tablename__ not in existing
+        version = versions.get(cls.__tablename__)
+        if create or version is None or int(version) < len(cls.__versions__):
+            plan.append((cls, create, version))
+    return 'versions' not in existing, plan
 
 
 async def db_migrate():
     """Gets all subclasses and checks their migrations."""
-    async with Pool.acquire() as conn:
-        await conn.execute(
-            """CREATE TABLE IF NOT EXISTS versions (table_name text PRIMARY KEY, version_num int NOT NULL)""")
+    global Pool
     logger.info("Checking for db migrations")
-    for cls in DatabaseTable.__subclasses__():
-        exists = await Pool.fetchrow("""SELECT EXISTS(
-        SELECT 1
-        FROM information_schema.tables
-        WHERE
-        table_name = $1)""", cls.__tablename__)
-        if not exists['exists']:
-            await cls.initial_create()
-
-        version = await Pool.fetchrow("""SELECT version_num FROM versions WHERE table_name = $1""",
-                                      cls.__tablename__)
-        if version is None:
-            # Migration/creation required, go to the function in the subclass for it
-            await cls.initial_migrate()
-            version = {"version_num": 0}
-        if int(version["version_num"]) < len(cls.__versions__):
-            # the version in the DB is less than the version in the bot, run all the migrate scripts necessary
-            logger.info(f"Table {cls.__tablename__} is out of date attempting to migrate")
-            for i in range(int(version["version_num"]), len(cls.__versions__)):
-                # Run the update script for this version!
-                await cls.__versions__[i](cls)
-                logger.info(f"Successfully updated table {cls.__tablename__} from version {i} to {i + 1}")
-            async with Pool.acquire() as conn:
-                await conn.execute("""UPDATE versions SET version_num = $1 WHERE table_name = $2""",
-                                   len(cls.__versions__), cls.__tablename__)
+    tables = _table_classes()
+    async with Pool.acquire() as conn:
+        create_versions, plan = await _migration_plan(conn, tables)
+        if not create_versions and not plan:
+            logger.info("All db migrations complete.")
+            return
+
+        async with conn.transaction():
+            # only one instance (e.g. the primary and a backup booting together) may migrate at a time;
+            # the plan is recomputed once the lock is held in case the other one already did the work
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('dozer_db_migrate'))")
+            await conn.execute(
+                """CREATE TABLE IF NOT EXISTS versions (table_name text PRIMARY KEY, version_num int NOT NULL)""")
+            _, plan = await _migration_plan(conn, tables)
+
+            pool, Pool = Pool, _MigrationPool(conn)
+            try:
+                for cls, create, version in plan:
+                    if create:
+                        await cls.initial_create()
+                    if version is None:
+                        # Migration/creation required, go to the function in the subclass for it
+                        await cls.initial_migrate()
+                        version = 0
+                    if int(version) < len(cls.__versions__):
+                        # the version in the DB is less than the version in the bot, run all the migrate scripts
+                        logger.info(f"Table {cls.__tablename__} is out of date attempting to migrate")
+                        for i in range(int(version), len(cls.__versions__)):
+                            # Run the update script for this version!
+                            await cls.__versions__[i](cls)
+                            logger.info(f"Successfully updated table {cls.__tablename__} from version {i} to {i + 1}")
+                        await conn.execute("""UPDATE versions SET version_num = $1 WHERE table_name = $2""",
+                                           len(cls.__versions__), cls.__tablename__)
+            finally:
+                Pool = pool
     logger.info("All db migrations complete.")
 
 
@@ -69,9 +315,8 @@ class DatabaseTable:
     def nullify():
         """Function to be referenced when a table entry value needs to be set to null"""
 
-    async def update_or_add(self):
-        """Assign the attribute to this object, then call this method to either insert the object if it doesn't exist in
-        the DB or update it if it does exist. It will update every column not specified in __uniques__."""
+    def _upsert_statement(self):
+        """Builds the statement and arguments used by update_or_add"""
         keys = []
         values = []
         for var, value in self.__dict__.items():
@@ -93,22 +338,35 @@ class DatabaseTable:
                 updates += " ;"
             else:
                 updates += ", \n"
+        if updates:
+            statement = f"""
+            INSERT INTO {self.__tablename__} ({", ".join(keys)})
+            VALUES({','.join(f'${i + 1}' for i in range(len(values)))})
+            ON CONFLICT ({self.__uniques__}) DO UPDATE
+            SET {updates}
+            """
+        else:
+            statement = f"""
+            INSERT INTO {self.__tablename__} ({", ".join(keys)})
+            VALUES({','.join(f'${i + 1}' for i in range(len(values)))})
+            ON CONFLICT ({self.__uniques__}) DO NOTHING;
+            """
+        return statement, values
+
+    async def update_or_add(self):
+        """Assign the attribute to this object, then call this method to either insert the object if it doesn't exist in
+        the DB or update it if it does exist. It will update every column not specified in __uniques__."""
+        statement, values = self._upsert_statement()
+        await Writer.flush_table(self.__tablename__)
         async with Pool.acquire() as conn:
-            if updates:
-                statement = f"""
-                INSERT INTO {self.__tablename__} ({", ".join(keys)})
-                VALUES({','.join(f'${i + 1}' for i in range(len(values)))})
-                ON CONFLICT ({self.__uniques__}) DO UPDATE
-                SET {updates}
-                """
-            else:
-                statement = f"""
-                INSERT INTO {self.__tablename__} ({", ".join(keys)})
-                VALUES({','.join(f'${i + 1}' for i in range(len(values)))})
-                ON CONFLICT ({self.__uniques__}) DO NOTHING;
-                """
             await conn.execute(statement, *values)
 
+    async def update_or_add_later(self):
+        """Like update_or_add, but queues the write on the batched writer instead of waiting for it. Reads and deletes
+        through this class flush the queue for the table first, so they still see the write."""
+        statement, values = self._upsert_statement()
+        await Writer.queue(self.__tablename__, statement, values)
+
     async def add(self):
         """Assign the attribute to this object, then call this method to either the object if it doesn't exist in
         the DB."""
@@ -142,10 +400,19 @@ class DatabaseTable:
 
     # Class Methods
 
+    @classmethod
+    def from_record(cls, record):
+        """Builds an object straight from a database row (or any column -> value mapping), bypassing __init__. Only
+        suitable for tables whose attribute names match their column names."""
+        obj = cls.__new__(cls)
+        obj.__dict__.update(record)
+        return obj
+
     @classmethod
     async def get_by(cls, **filters):
         """Get a list of all records matching the given column=value criteria. This will grab all attributes, it's more
         efficent to write your own SQL queries than use this one, but for a simple query this is fine."""
+        await Writer.flush_table(cls.__tablename__)
         async with Pool.acquire() as conn:
             statement = f"SELECT * FROM {cls.__tablename__}"
             if filters:
@@ -159,7 +426,8 @@ class DatabaseTable:
 
     @classmethod
     async def delete(cls, **filters):
-        """Deletes by any number of criteria specified as column=value keyword arguments. Returns the number of entries deleted"""
+        """Deletes by any number of criteria specified as column=value keyword arguments. Returns the number of entries deleted."""
+        await Writer.flush_table(cls.__tablename__)
         async with Pool.acquire() as conn:
             if filters:
                 # This code relies on properties of dicts - see get_by
@@ -170,12 +438,108 @@ class DatabaseTable:
                 statement = f"TRUNCATE {cls.__tablename__};"
             return await conn.execute(statement, *filters.values())
 
+    @classmethod
+    async def delete_any(cls, column: str, values):
+        """Deletes every entry whose column matches any of the given values, in a single statement. Returns the number of
+        entries deleted."""
+        await Writer.flush_table(cls.__tablename__)
+        async with Pool.acquire() as conn:
+            statement = f"DELETE FROM {cls.__tablename__} WHERE {column} = ANY($1);"
+            status = await conn.execute(statement, list(values))
+        # the status string ends in the number of deleted rows, e.g. "DELETE 3"
+        return int(status.rsplit(' ', 1)[-1])
+
     @classmethod
     async def set_initial_version(cls):
         """Sets initial version"""
         await Pool.execute("""INSERT INTO versions (table_name, version_num) VALUES ($1,$2)""", cls.__tablename__, 0)
 
 
+class BatchedWriter:
+    """
+    Write-behind queue for inserts and upserts that don't need to be waited on. Writes are grouped by statement and
+    sent with executemany once `flush_interval` seconds pass or `max_batch` writes are queued. Queuing waits for a flush
+    once `max_pending` writes are outstanding, so a stalled database slows producers down instead of growing the queue.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, max_batch: int = 500, max_pending: int = 5000):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.pending: Dict[Tuple[str, str], list] = {}  # (table, statement): [argument tuples]
+        self.pending_count = 0
+        self._flush_handle = None
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+        self.in_flight: Set[str] = set()  # tables with writes taken off the queue by a flush that hasn't finished
+
+    async def queue(self, table: str, statement: str, args):
+        """Queues a statement to be executed with the given arguments on the next flush."""
+        if self.pending_count >= self.max_pending:
+            await self.flush()
+        self.pending.setdefault((table, statement), []).append(tuple(args))
+        self.pending_count += 1
+        if self.pending_count >= self.max_batch:
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self.flush())
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.flush_interval, lambda: asyncio.create_task(self.flush()))
+
+    async def flush_table(self, table: str):
+        """Flushes the queue if it holds writes to the table, and waits for a flush already writing to it, so a following
+        read or delete sees them."""
+        if table in self.in_flight or any(pending_table == table for pending_table, _ in self.pending):
+            await self.flush()
+
+    async def flush(self):
+        """Executes every queued write."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        async with self._lock:
+            if not self.pending or Pool is None:
+                # before db_init there is nowhere to write to, so queued rows stay queued until there is
+                return
+            batch, self.pending, self.pending_count = self.pending, {}, 0
+            self.in_flight = {table for table, _ in batch}
+            written = set()
+            try:
+                async with Pool.acquire() as conn:
+                    for (table, statement), args in batch.items():
+                        try:
+                            await conn.executemany(statement, args)
+                        except Exception as e:
+                            # executemany is atomic, so one bad row rolls back the batch; retry the rows one at a time
+                            # so only the bad ones are dropped
+                            logger.warning(f"Batched write of {len(args)} row(s) to {table} failed ({e}), retrying "
+                                           f"row by row")
+                            await self._write_rows(conn, table, statement, args)
+                        written.add((table, statement))
+            except Exception as e:
+                # the connection couldn't be acquired or was lost; like MessageStore.flush, what's left is logged and dropped
+                dropped = {}
+                for (table, statement), args in batch.items():
+                    if (table, statement) not in written:
+                        dropped[table] = dropped.get(table, 0) + len(args)
+                logger.error(f"Failed to write queued rows ({e}), dropped " +
+                             ", ".join(f"{count} to {table}" for table, count in dropped.items()))
+            finally:
+                self.in_flight = set()
+
+    @staticmethod
+    async def _write_rows(conn, table: str, statement: str, rows: list):
+        """Executes a statement once per row, logging the rows that fail."""
+        for args in rows:
+            try:
+                await conn.execute(statement, *args)
+            except Exception as e:
+                logger.error(f"Failed to write queued row {args!r} to {table}: {e}")
+
+
+Writer = BatchedWriter()
+
+
 class ConfigCache:
     """Class that will reduce calls to sqlalchemy as much as possible. Has no growth limit (yet)"""
 
@@ -0,0 +1,235 @@
+"""Latency histograms for listeners, commands, database queries and Discord HTTP requests."""
+import bisect
+import contextvars
+import functools
+import time
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+__all__ = ["Histogram", "Span", "MetricsRegistry", "registry", "current_span", "span", "instrument_listener",
+           "start_command", "finish_command", "record_db", "record_http", "timed_http", "MetricsServer"]
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Histogram:
+    """Counts observations into fixed latency buckets, along with their sum and maximum."""
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        """Records one observation."""
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """Returns the upper bound of the bucket holding the q-th quantile (the maximum for the last bucket)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        """Average observation"""
+        return self.sum / self.count if self.count else 0.0
+
+
+class Span:
+    """Time spent in one listener call or command invocation, including the database and HTTP time inside it."""
+    __slots__ = ("kind", "name", "start", "db", "http")
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.http = 0.0
+
+
+class MetricsRegistry:
+    """Holds a histogram per (metric, label), e.g. ("listener", "Roles.on_member_join")."""
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+
+    def observe(self, metric: str, label: str, seconds: float):
+        """Records an observation in the histogram of (metric, label)."""
+        histogram = self.histograms.get((metric, label))
+        if histogram is None:
+            histogram = self.histograms[(metric, label)] = Histogram()
+        histogram.observe(seconds)
+
+    def finish(self, current: Span):
+        """Records the wall, database and HTTP time of a finished span."""
+        self.observe(current.kind, current.name, time.perf_counter() - current.start)
+        if current.db:
+            self.observe(f"{current.kind}_db", current.name, current.db)
+        if current.http:
+            self.observe(f"{current.kind}_http", current.name, current.http)
+
+    def top(self, metric: Optional[str] = None, n: int = 10, key: str = "sum") -> List[Tuple[str, str, Histogram]]:
+        """Returns the n histograms (optionally of one metric) with the largest total time, or the given attribute."""
+        items = [(m, label, h) for (m, label), h in self.histograms.items() if metric is None or m == metric]
+        items.sort(key=lambda item: getattr(item[2], key), reverse=True)
+        return items[:n]
+
+    def reset(self):
+        """Drops every histogram."""
+        self.histograms.clear()
+
+    def render_prometheus(self) -> str:
+        """Renders every histogram in the Prometheus text exposition format."""
+        lines = []
+        by_metric: Dict[str, list] = {}
+        for (metric, label), histogram in sorted(self.histograms.items()):
+            by_metric.setdefault(metric, []).append((label, histogram))
+        for metric, histograms in by_metric.items():
+            name = f"dozer_{metric}_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for label, histogram in histograms:
+                label = label.replace('\\', '\\\\').replace('"', '\\"')
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{{name="{label}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{name="{label}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{name="{label}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+class span:
+    """Context manager timing a listener call or command invocation as the current span."""
+
+    def __init__(self, kind: str, name: str):
+        self.span = Span(kind, name)
+        self.token = None
+
+    def __enter__(self):
+        self.token = current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        current_span.reset(self.token)
+        registry.finish(self.span)
+        return False
+
+
+def instrument_listener(name: str, func):
+    """Wraps a listener coroutine so each call is timed under `name`."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with span("listener", name):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+def start_command(ctx, name: str):
+    """Starts timing a command invocation as the current span. Spans are kept on the context, since the start and end
+    of an invocation happen in different hooks."""
+    spans = getattr(ctx, "metrics_spans", None)
+    if spans is None:
+        spans = ctx.metrics_spans = {}
+    if name in spans:
+        return
+    command_span = Span("command", name)
+    spans[name] = (command_span, current_span.get())
+    current_span.set(command_span)
+
+
+def finish_command(ctx, name: str = None):
+    """Records a command invocation started with start_command, or every unfinished one on the context. Each span is
+    recorded once, so calling this again for the same invocation does nothing."""
+    spans = getattr(ctx, "metrics_spans", None)
+    if not spans:
+        return
+    names = [name] if name is not None else list(reversed(spans))
+    for name in names:
+        entry = spans.pop(name, None)
+        if entry is None:
+            continue
+        command_span, previous = entry
+        registry.finish(command_span)
+        if current_span.get() is command_span:
+            current_span.set(previous)
+
+
+def record_db(seconds: float, label: str = "query"):
+    """Records database time, attributing it to the current span if there is one."""
+    registry.observe("db", label, seconds)
+    current = current_span.get()
+    if current is not None:
+        current.db += seconds
+
+
+def record_http(seconds: float, route: str):
+    """Records Discord HTTP time, attributing it to the current span if there is one."""
+    registry.observe("http", route, seconds)
+    current = current_span.get()
+    if current is not None:
+        current.http += seconds
+
+
+def timed_http(request):
+    """Wraps discord.py's HTTPClient.request so every Discord API call is timed by route."""
+
+    @functools.wraps(request)
+    async def wrapper(route, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(route, *args, **kwargs)
+        finally:
+            record_http(time.perf_counter() - start, f"{route.method} {route.path}")
+
+    return wrapper
+
+
+class MetricsServer:
+    """Serves the histograms at /metrics in the Prometheus text format, on localhost only."""
+
+    def __init__(self, port: int, host: str = "127.0.0.1"):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        """Starts listening."""
+        from aiohttp import web
+
+        async def handle(_request):
+            return web.Response(text=registry.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        """Stops listening."""
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
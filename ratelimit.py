@@ -0,0 +1,89 @@
+"""Token bucket rate limiting for command invocations."""
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Tuple
+
+__all__ = ["TokenBucketLimiter", "CommandRateLimiter"]
+
+
+class TokenBucketLimiter:
+    """
+    Keyed token buckets holding up to `burst` tokens that refill at `rate` tokens per `per` seconds. Buckets live in an
+    LRU ordered dict: a bucket idle long enough to refill completely is indistinguishable from a new one, so it is
+    dropped, and at most `max_buckets` are kept, so memory stays bounded however many keys are seen.
+    """
+
+    def __init__(self, rate: float, per: float, burst: float = None, max_buckets: int = 10000):
+        self.rate = rate / per  # tokens per second
+        self.burst = burst if burst is not None else rate
+        self.max_buckets = max_buckets
+        self.idle_after = self.burst / self.rate  # seconds after which an untouched bucket is full again
+        self.buckets: "OrderedDict[Hashable, list]" = OrderedDict()  # key: [tokens, time of last update]
+
+    def _tokens(self, key: Hashable, now: float) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def retry_after(self, key: Hashable, now: float = None) -> float:
+        """Returns how long until `key` has a token available, without taking one. 0 if it has one now."""
+        now = time.monotonic() if now is None else now
+        tokens = self._tokens(key, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def consume(self, key: Hashable, now: float = None):
+        """Takes a token from the bucket of `key`."""
+        now = time.monotonic() if now is None else now
+        tokens = self._tokens(key, now) - 1
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = [tokens, now]
+        else:
+            bucket[0], bucket[1] = tokens, now
+            self.buckets.move_to_end(key)
+        self._evict(now)
+
+    def _evict(self, now: float):
+        # least recently used buckets are at the front, so eviction stops at the first one still in use
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) <= self.max_buckets and now - bucket[1] < self.idle_after:
+                break
+            del self.buckets[key]
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class CommandRateLimiter:
+    """
+    Limits command invocations per user, per guild and per (user, command). An invocation only takes tokens when
+    every bucket it belongs to has one, so a rejected invocation doesn't count against the other limits.
+    """
+
+    default_limits: Dict[str, Tuple[float, float]] = {
+        "user": (5, 5),  # 5 commands per 5 seconds per user
+        "guild": (30, 10),  # 30 commands per 10 seconds per guild
+        "command": (2, 3),  # the same command twice per 3 seconds per user
+    }
+
+    def __init__(self, limits: Dict[str, Iterable[float]] = None):
+        limits = {**self.default_limits, **(limits or {})}
+        self.limiters = {scope: TokenBucketLimiter(*limit) for scope, limit in limits.items()}
+
+    def keys(self, user_id: int, guild_id: int, command: str):
+        """Returns the bucket key of an invocation for each scope."""
+        return {"user": user_id, "guild": guild_id, "command": (user_id, command)}
+
+    def hit(self, user_id: int, guild_id: int, command: str) -> float:
+        """Records an invocation if every bucket allows it and returns 0, otherwise returns the seconds to wait."""
+        now = time.monotonic()
+        keys = [(self.limiters[scope], key) for scope, key in self.keys(user_id, guild_id, command).items()
+                if scope in self.limiters and key is not None]
+        retry_after = max((limiter.retry_after(key, now) for limiter, key in keys), default = 0)
+        if retry_after:
+            return retry_after
+        for limiter, key in keys:
+            limiter.consume(key, now)
+        return 0
@@ -0,0 +1,147 @@
+"""A single-task scheduler for durable, keyed expiration timers (punishments, temporary roles, etc)."""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from loguru import logger
+
+__all__ = ["TimerEntry", "TimerScheduler"]
+
+
+class TimerEntry:
+    """A pending timer. `payload` is whatever the scheduling cog needs to act on the expiration, usually a DB record."""
+    __slots__ = ("kind", "key", "due", "payload", "cancelled")
+
+    def __init__(self, kind: str, key: Hashable, due: float, payload: Any = None):
+        self.kind = kind
+        self.key = key
+        self.due = due
+        self.payload = payload
+        self.cancelled = False
+
+    @property
+    def remaining(self) -> float:
+        """Seconds until this timer expires, never negative."""
+        return max(self.due - time.time(), 0)
+
+    def __repr__(self):
+        return f"<TimerEntry kind={self.kind!r} key={self.key!r} due={self.due} remaining={self.remaining:.0f}s>"
+
+
+class TimerScheduler:
+    """
+    Keeps every pending timer in one min-heap of due times and runs a single wake-up loop that dispatches expirations
+    in batches. Timers are identified by (kind, key), so scheduling the same key again reschedules it instead of creating
+    a duplicate. Persistence is left to the owning cog: it stores the record in its own table and re-schedules it from
+    there on startup.
+    """
+
+    def __init__(self, batch_size: int = 50):
+        self.batch_size = batch_size
+        self._heap: List[Tuple[float, int, TimerEntry]] = []
+        self._entries: Dict[Tuple[str, Hashable], TimerEntry] = {}
+        self._handlers: Dict[str, Callable[[TimerEntry], Awaitable[None]]] = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, kind: str, handler: Callable[[TimerEntry], Awaitable[None]]):
+        """Sets the coroutine that gets called with each expired entry of `kind`. Re-registering replaces the handler."""
+        self._handlers[kind] = handler
+
+    def schedule(self, kind: str, key: Hashable, due: float, payload: Any = None) -> TimerEntry:
+        """Schedules (or reschedules) the timer `(kind, key)` to expire at the unix timestamp `due`."""
+        old = self._entries.get((kind, key))
+        if old is not None:
+            old.cancelled = True
+        entry = TimerEntry(kind, key, due, payload)
+        self._entries[(kind, key)] = entry
+        heapq.heappush(self._heap, (due, next(self._counter), entry))
+        if self._heap[0][2] is entry:
+            self._wakeup.set()  # new earliest deadline, the loop has to recompute its sleep
+        return entry
+
+    def cancel(self, kind: str, key: Hashable) -> bool:
+        """Cancels a pending timer. Returns whether there was one to cancel."""
+        entry = self._entries.pop((kind, key), None)
+        if entry is None:
+            return False
+        entry.cancelled = True  # lazily dropped from the heap once it reaches the top
+        return True
+
+    def cancel_all(self, kind: str) -> int:
+        """Cancels every pending timer of a kind, returning how many were cancelled."""
+        keys = [k for k in self._entries if k[0] == kind]
+        for k in keys:
+            self._entries.pop(k).cancelled = True
+        return len(keys)
+
+    def get(self, kind: str, key: Hashable) -> Optional[TimerEntry]:
+        """Returns the pending timer for a key, if there is one."""
+        return self._entries.get((kind, key))
+
+    def pending(self, kind: str = None) -> List[TimerEntry]:
+        """Returns pending timers ordered by due time, optionally restricted to one kind."""
+        entries = (e for e in self._entries.values() if kind is None or e.kind == kind)
+        return sorted(entries, key = lambda e: e.due)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self):
+        """Starts the wake-up loop. Must be called from within a running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name = "TimerScheduler")
+
+    async def stop(self):
+        """Stops the wake-up loop. Pending timers are kept and will resume if the scheduler is started again."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _pop_due(self, now: float) -> List[TimerEntry]:
+        """Pops up to `batch_size` expired entries off the heap, discarding cancelled ones along the way."""
+        due = []
+        while self._heap and len(due) < self.batch_size:
+            ts, _, entry = self._heap[0]
+            if entry.cancelled:
+                heapq.heappop(self._heap)
+                continue
+            if ts > now:
+                break
+            heapq.heappop(self._heap)
+            del self._entries[(entry.kind, entry.key)]
+            due.append(entry)
+        return due
+
+    async def _dispatch(self, entry: TimerEntry):
+        handler = self._handlers.get(entry.kind)
+        if handler is None:
+            logger.warning(f"No handler registered for expired timer {entry!r}, dropping it")
+            return
+        try:
+            await handler(entry)
+        except Exception as e:
+            logger.error(f"Error while handling expired timer {entry!r}: {e}")
+            logger.exception(e)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            batch = self._pop_due(time.time())
+            if batch:
+                logger.debug(f"Dispatching {len(batch)} expired timer(s)")
+                await asyncio.gather(*(self._dispatch(entry) for entry in batch))
+                continue
+
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout = timeout)
+            except asyncio.TimeoutError:
+                pass